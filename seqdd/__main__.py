@@ -1,29 +1,137 @@
 import argparse
+import functools
 import os
-import platform
 import re
 import logging
+import stat
+import sys
+from collections.abc import Iterable
 from sys import stderr
 from tempfile import gettempdir
-
-from .register.reg_manager import save_source, create_register, Register
+try:
+    from itertools import batched
+except ImportError:
+    # Python < 3.12
+    from itertools import islice
+
+    def batched(iterable, n):
+        iterator = iter(iterable)
+        while batch := tuple(islice(iterator, n)):
+            yield batch
+
+from .register.reg_manager import create_register, Register
 from .register.src_manager import SourceManager
-from .utils.download import DownloadManager
 
 
+@functools.cache
 def threads_available() -> int:
     """
+    The value is computed once per process.
 
     :return: The maximal number of threads available.
              It's nice with cluster scheduler or linux.
              On Mac it uses the number of physical cores
     """
-    if hasattr(os, "sched_getaffinity"):
+    threads_nb = None
+    # Python >= 3.13: affinity aware count without building the cpu set
+    if hasattr(os, "process_cpu_count"):
+        threads_nb = os.process_cpu_count()
+    elif hasattr(os, "sched_getaffinity"):
         threads_nb = len(os.sched_getaffinity(0))
-    else:
+    if not threads_nb:
         threads_nb = os.cpu_count()
-    return threads_nb
+    # cpu_count can return None when undetermined
+    return threads_nb or 1
+
+
+
+@functools.lru_cache(maxsize=512)
+def compile_regexp(regexp: str) -> re.Pattern | None:
+    """
+    Compiles a regular expression. The results are memoized.
+
+    :param regexp: The regular expression to compile
+    :return: The compiled pattern or None if the regular expression is invalid.
+    """
+    try:
+        return re.compile(regexp)
+    except re.error:
+        return None
+
+
+class AnyPattern:
+    """
+    Matches a string against several patterns, one after the other.
+    Used when the patterns cannot be merged in a single regular expression.
+    """
+
+    def __init__(self, patterns: list[re.Pattern]) -> None:
+        """
+        :param patterns: The compiled patterns
+        """
+        self.patterns = patterns
+        """The compiled patterns, tried in order"""
+
+
+    def match(self, string: str) -> bool:
+        """
+        :param string: The string to match
+        :return: True if any of the patterns matches the beginning of the string
+        """
+        return any(pattern.match(string) for pattern in self.patterns)
+
+
+unmergeable = re.compile(r'\\[1-9]|\(\?\([0-9]|\(\?[aiLmsux]+\)')
+"""Detects what changes meaning in a union of regexps: the numbered group references (shifted)
+and the global inline flags (applied to the whole union, or refused when not at the start)."""
+
+
+def compile_patterns(regexps: Iterable[str], logger: logging.Logger) -> re.Pattern | AnyPattern | None:
+    """
+    Validates the user regular expressions and compiles their union.
+    The invalid regular expressions are ignored with a warning.
+    The regular expressions that cannot be merged (inline global flags, numbered backreferences, ...)
+    are matched one by one.
+
+    :param regexps: The regular expressions given by the user
+    :param logger: The object to log
+    :return: A pattern matching any of the valid regexps. None if there is no valid regexp.
+    """
+    valid_regexp = []
+    for regexp in regexps:
+        if compile_regexp(regexp) is None:
+            logger.warning("Invalid regular expression %s. Not used for search.", regexp)
+        else:
+            valid_regexp.append(regexp)
+
+    if len(valid_regexp) == 0:
+        return None
+    if len(valid_regexp) == 1:
+        return compile_regexp(valid_regexp[0])
+
+    # Union of the regexps to match all of them in one pass
+    union = None
+    if not any(unmergeable.search(regexp) for regexp in valid_regexp):
+        union = compile_regexp('|'.join(f'(?:{regexp})' for regexp in valid_regexp))
+    if union is None:
+        logger.warning("The regular expressions cannot be merged in a single one (inline flags or group references). "
+                       "They are matched one by one.")
+        return AnyPattern([compile_regexp(regexp) for regexp in valid_regexp])
+    return union
+
+
+def probe(filepath: str) -> os.stat_result | None:
+    """
+    Single stat call replacing the exists/isdir/isfile checks.
 
+    :param filepath: The path to probe
+    :return: The stat result of the path or None if the path cannot be reached
+             (missing, under a file, not allowed, ...).
+    """
+    try:
+        return os.stat(filepath)
+    except OSError:
+        return None
 
 
 def parse_cmd(logger: logging.Logger) -> argparse.Namespace:
@@ -40,6 +148,8 @@ def parse_cmd(logger: logging.Logger) -> argparse.Namespace:
                     formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
 
+    source_keys = SourceManager.source_keys()
+
     subparsers = parser.add_subparsers(dest='cmd',
                                        required=True,
                                        help='command to apply')
@@ -59,7 +169,7 @@ def parse_cmd(logger: logging.Logger) -> argparse.Namespace:
                                 help='Add dataset(s) to manage',
                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     add.add_argument('-s', '--source',
-                     choices=SourceManager.source_keys(),
+                     choices=source_keys,
                      help='Download source. Can download from ncbi genomes, '
                           'sra or an arbitrary url (uses wget to download)',
                      required=True)
@@ -108,7 +218,7 @@ def parse_cmd(logger: logging.Logger) -> argparse.Namespace:
                                      '5 accessions are displayed per line (tabulation separated).',
                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     lst.add_argument('-s', '--source',
-                     choices=['ncbi', 'sra', 'url'],
+                     choices=source_keys,
                      help='List only the datasets from the given source. If not specified, list all the datasets.')
     lst.add_argument('-r', '--regular-expressions',
                      nargs='+',
@@ -120,7 +230,7 @@ def parse_cmd(logger: logging.Logger) -> argparse.Namespace:
                                    help='Remove dataset(s) from the register',
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     remove.add_argument('-s', '--source',
-                        choices=['ncbi', 'sra', 'url'],
+                        choices=source_keys,
                         help='Delete only from the given source. If not specified, removed from all the sources.')
     remove.add_argument('-a', '--accessions',
                         nargs='+',
@@ -134,10 +244,21 @@ def parse_cmd(logger: logging.Logger) -> argparse.Namespace:
                                help='Directory that store all info for the register')
 
     args = parser.parse_args()
+    finalize_args(args)
 
     return args
 
 
+def finalize_args(args: argparse.Namespace) -> None:
+    """
+    Computes once the paths derived from the parsed arguments.
+
+    :param args: The parsed cmd line arguments. Modified in place.
+    """
+    args.bin_dir = os.path.join(args.register_location, 'bin')
+    args.valcache_dir = os.path.join(args.register_location, '.valcache')
+
+
 def on_remove(args: argparse.Namespace, logger: logging.Logger) -> None:
     """
     function corresponding to sub command `remove`
@@ -145,22 +266,17 @@ def on_remove(args: argparse.Namespace, logger: logging.Logger) -> None:
     :param args: The parsed cmd line arguments
     :param logger: The object to log
     """
-     # validate the regexps
-    valid_regexp = []
-    for regexp in args.accessions:
-        try:
-            re.compile(regexp)
-            valid_regexp.append(regexp)
-        except re.error:
-            logger.warning(f"Invalid regular expression {regexp}. Not used for search.")
+    pattern = compile_patterns(args.accessions, logger)
 
-    reg = Register(logger, dirpath=args.register_location)
-    src_names = reg.acc_by_src.keys() if args.source is None else [args.source]
-    for name in src_names:
-        acc_lst = reg.filter_accessions(name, valid_regexp)
-        for acc in acc_lst:
-            reg.remove_accession(name, acc)
-    reg.save_to_dir(args.register_location)
+    sources = None if args.source is None else [args.source]
+    reg = Register(logger, dirpath=args.register_location, sources=sources)
+    # Filter all the sources before modifying the register
+    to_remove = {name: reg.filter_accessions(name, pattern) for name, accs in reg.acc_by_src.items() if accs}
+    modified = [name for name, acc_lst in to_remove.items() if len(acc_lst) > 0]
+    for name in modified:
+        reg.remove_accessions(name, to_remove[name])
+    if len(modified) > 0:
+        reg.save_to_dir(args.register_location, modified=modified)
 
 
 def on_list(args: argparse.Namespace, logger: logging.Logger) -> None:
@@ -170,25 +286,21 @@ def on_list(args: argparse.Namespace, logger: logging.Logger) -> None:
     :param args: The parsed cmd line arguments
     :param logger: The object to log
     """
-    # validate the regexps
-    valid_regexp = []
-    for regexp in args.regular_expressions:
-        try:
-            re.compile(regexp)
-            valid_regexp.append(regexp)
-        except re.error:
-            logger.warning(f"Invalid regular expression {regexp}. Not used for search.")
-
-    reg = Register(logger, dirpath=args.register_location)
-    src_names = reg.acc_by_src.keys() if args.source is None else args.source
-    for name in src_names:
-        acc_lst = reg.filter_accessions(name, valid_regexp)
-
+    pattern = compile_patterns(args.regular_expressions, logger)
+
+    sources = None if args.source is None else [args.source]
+    reg = Register(logger, dirpath=args.register_location, sources=sources)
+    # Filter all the sources before printing
+    matching = {name: reg.filter_accessions(name, pattern) for name, accs in reg.acc_by_src.items() if accs}
+    # Prepare the whole output to print it with a single write
+    lines = []
+    for name, acc_lst in matching.items():
         if len(acc_lst) > 0:
-            print(f"- {name}:")
-            for idx in range(0, len(acc_lst), 5):
-                current_slice = acc_lst[idx:idx+5]
-                print("\t".join(current_slice))
+            lines.append(f"- {name}:")
+            # Register order, sliced without an intermediate copy
+            lines.extend("\t".join(current_slice) for current_slice in batched(acc_lst, 5))
+    if len(lines) > 0:
+        sys.stdout.write("\n".join(lines) + "\n")
 
 
 def on_init(args: argparse.Namespace, logger:logging.Logger) -> None:
@@ -204,7 +316,7 @@ def on_init(args: argparse.Namespace, logger:logging.Logger) -> None:
     if args.register_file is not None:
         register.load_from_file(args.register_file)
         register.save_to_dir(location)
-    logger.info(f'Created at location {args.register_location}')
+    logger.info('Created at location %s', args.register_location)
 
 
 def on_add(args: argparse.Namespace, logger:logging.Logger) -> None:
@@ -214,12 +326,13 @@ def on_add(args: argparse.Namespace, logger:logging.Logger) -> None:
     :param args: The parsed cmd line arguments
     :param logger: The object to log
     """
-    # Getting the file to the sources
-    src_path = os.path.join(args.register_location, f"{args.source}.txt")
-    bin_dir = os.path.join(args.register_location, 'bin')
+    # Only needed by this command, not imported for the others
+    import sqlite3
+    from .register.validity_cache import ValidityCache
+
     # load the register
-    src_mng = SourceManager(args.tmp_directory, bin_dir, logger)
-    register = Register(logger, dirpath=args.register_location)
+    src_mng = SourceManager(args.tmp_directory, args.bin_dir, logger)
+    register = Register(logger, dirpath=args.register_location, sources=[args.source])
 
     # Load previous accession list
     accessions = register.acc_by_src.get(args.source, set())
@@ -229,21 +342,47 @@ def on_add(args: argparse.Namespace, logger:logging.Logger) -> None:
     new_accessions = set()
     if len(args.accessions) > 0:
         new_accessions.update(args.accessions)
-    if os.path.isfile(args.file_of_accessions):
-        with open(args.file_of_accessions) as fr:
-            new_accessions.update(x.strip() for x in fr if len(x.strip()) > 0)
+    if len(args.file_of_accessions) > 0:
+        try:
+            with open(args.file_of_accessions) as fr:
+                # Streamed line by line. strip and the empty lines filtering run in C
+                new_accessions.update(filter(None, map(str.strip, fr)))
+        except OSError as e:
+            logger.warning("File of accessions %s cannot be read (%s). Skipped.", args.file_of_accessions, e.strerror)
+
+    # Accessions already in the register do not need a validation (both are sets: O(len(new_accessions)))
+    new_accessions.difference_update(accessions)
 
-    # Verification of the accessions
+    # Verification of the accessions. The accessions validated during previous runs are not queried again.
     src_manip = src_mng.sources[args.source]
-    valid_accessions = src_manip.filter_valid_accessions(frozenset(args.accessions))
-    
+    # The cache is only an optimization: the command works without it.
+    cache_ok = True
+    try:
+        with ValidityCache(args.valcache_dir) as cache:
+            valid_accessions, unknown_accessions = cache.split_known(args.source, new_accessions)
+    except (sqlite3.Error, OSError) as e:
+        logger.warning("Validity cache %s unavailable (%s). All the accessions are validated.", args.valcache_dir, e)
+        cache_ok = False
+        valid_accessions, unknown_accessions = set(), set(new_accessions)
+
+    if len(unknown_accessions) > 0:
+        # Validated outside of the cache transaction: the database is not locked during the queries
+        newly_validated = src_manip.filter_valid_accessions(unknown_accessions)
+        valid_accessions.update(newly_validated)
+        if cache_ok:
+            try:
+                with ValidityCache(args.valcache_dir) as cache:
+                    cache.add_valid(args.source, newly_validated)
+            except (sqlite3.Error, OSError) as e:
+                logger.warning("The validated accessions cannot be saved in the validity cache (%s).", e)
+
     # Add valid accessions
     accessions.update(valid_accessions)
-    logger.info(f"{len(accessions) - size_before} accessions added to the register")
+    logger.info("%d accessions added to the register", len(accessions) - size_before)
 
     # Save the register
     if len(accessions) > size_before:
-        save_source(src_path, accessions)
+        register.save_to_dir(args.register_location, modified=[args.source])
 
 
 def on_download(args: argparse.Namespace, logger: logging.Logger) -> None:
@@ -253,15 +392,17 @@ def on_download(args: argparse.Namespace, logger: logging.Logger) -> None:
     :param args: The parsed cmd line arguments
     :param logger: The object to log
     """
+    # Only needed by this command, not imported for the others
+    from .utils.download import DownloadManager
+
     max_threads_available = threads_available()
     if args.max_processes > max_threads_available:
         args.max_processes = max_threads_available
-        logger.warning(f"The maximal number of threads available is {max_threads_available} "
-                       f"set '--max-processes {max_threads_available}'.")
-    bindir = os.path.join(args.register_location, 'bin')
-    src_manager = SourceManager(args.tmp_directory, bindir, logger)
+        logger.warning("The maximal number of threads available is %d set '--max-processes %d'.",
+                       max_threads_available, max_threads_available)
+    src_manager = SourceManager(args.tmp_directory, args.bin_dir, logger)
     reg = Register(logger, dirpath=args.register_location)
-    dm = DownloadManager(reg, src_manager, logger, bindir, args.tmp_directory)
+    dm = DownloadManager(reg, src_manager, logger, args.bin_dir, args.tmp_directory)
     dm.download_to(args.download_directory, args.log_directory , args.max_processes)
 
 
@@ -274,7 +415,18 @@ def on_export(args: argparse.Namespace, logger:logging.Logger) -> None:
     """
     reg = Register(logger, dirpath=args.register_location)
     reg.save_to_file(args.output_register)
-    logger.info(f"Register exported to {args.output_register}")
+    logger.info("Register exported to %s", args.output_register)
+
+
+commands = {
+    'init': on_init,
+    'add': on_add,
+    'download': on_download,
+    'export': on_export,
+    'list': on_list,
+    'remove': on_remove
+}
+"""The function to apply for each sub command"""
 
 
 def main() -> None:
@@ -282,32 +434,30 @@ def main() -> None:
     main entry point to seqdd
     """
     # Platform check
-    system = platform.system()
-    if system == 'Windows':
+    if sys.platform == 'win32':
         print('Windows plateforms are not supported by seqdd.', file=stderr)
         exit(3)
 
-    # Setup the logger
+    # Setup the logger. Only once if main is called several times in the same interpreter.
     logger = logging.getLogger('seqdd')
-    logger.setLevel(logging.DEBUG)
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('[%(asctime)s - %(levelname)s] %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    if not logger.handlers:
+        logger.setLevel(logging.DEBUG)
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.INFO)
+        formatter = logging.Formatter('[%(asctime)s - %(levelname)s] %(message)s')
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
     args = parse_cmd(logger)
 
     # Verify the existence of the data register
     if args.cmd != 'init':
-        if not os.path.isdir(args.register_location):
+        register_stat = probe(args.register_location)
+        if register_stat is None or not stat.S_ISDIR(register_stat.st_mode):
             print('No data register found. Please first run the init command.', file=stderr)
             exit(1)
 
-
-
     # Apply the right command
-    cmd_to_apply = globals()[f"on_{args.cmd}"]
-    cmd_to_apply(args, logger=logger)
+    commands[args.cmd](args, logger=logger)
 
 if __name__ == "__main__":
     main()
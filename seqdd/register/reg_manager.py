@@ -1,7 +1,7 @@
 import logging
 from os import path, makedirs, remove
 from shutil import rmtree
-from typing import Iterable
+from typing import Collection, Iterable
 import re
 
 from seqdd.register.src_manager import SourceManager
@@ -22,18 +22,23 @@ class Register:
     """minor_version (int): The minor version of the register."""
 
 
-    def __init__(self, logger: logging.Logger, dirpath: str = None, regfile: str = None) -> None:
+    def __init__(self, logger: logging.Logger, dirpath: str = None, regfile: str = None,
+                 sources: Iterable[str] | None = None) -> None:
         """
         Initializes a Register object.
 
         :param logger: The logger object.
         :param dirpath: The directory path to load subregisters from.
         :param regfile: he file path to load the register from.
+        :param sources: The sources to manage. Only these subregisters are loaded and saved.
+                        If None, all the available sources are managed.
         """
         self.logger = logger
 
         # Initialize the subregisters
-        self.acc_by_src = {k: set() for k in SourceManager.source_keys()}
+        if sources is None:
+            sources = SourceManager.source_keys()
+        self.acc_by_src = {k: set() for k in sources}
 
         if dirpath is not None:
             self.load_from_dir(dirpath)
@@ -65,23 +70,26 @@ class Register:
         return True
 
 
-    def save_to_dir(self, dirpath: str) -> bool:
+    def save_to_dir(self, dirpath: str, modified: Iterable[str] | None = None) -> bool:
         """
         Saves subregisters to a directory.
 
         :param dirpath: The directory path to save subregisters to.
+        :param modified: The subregisters known to be modified. Only these ones are saved, without reading their file.
+                         If None, every subregister is saved, unless its file already contains the same accessions.
         :return: True if successful, False otherwise.
         """
         if not path.isdir(dirpath):
             self.logger.error(f"Register {dirpath} does not exist. Save aborted...")
             return False
 
-        # Iterate over all the subregisters
-        for key in self.acc_by_src:
+        keys = self.acc_by_src if modified is None else [key for key in modified if key in self.acc_by_src]
+        # Iterate over all the subregisters to save
+        for key in keys:
             src_path = path.join(dirpath, f"{key}.txt")
             if len(self.acc_by_src[key]) > 0:
-                # Save a subregister to its file
-                save_source(src_path, self.acc_by_src[key])
+                # Save a subregister to its file (an unknown state is compared to the file first)
+                save_source(src_path, self.acc_by_src[key], skip_unchanged=modified is None)
             elif path.exists(src_path):
                 # Remove the file if the subregister is empty
                 remove(src_path)
@@ -146,7 +154,9 @@ class Register:
                         remaining_to_read = int(split[1])
                 # Add the next accession from the current register
                 else :
-                    self.acc_by_src[current_register].add(line)
+                    # Skip the accessions of the sources that are not managed
+                    if current_register in self.acc_by_src:
+                        self.acc_by_src[current_register].add(line)
                     remaining_to_read -= 1
 
         self.logger.debug(f'Data from {file} successfully loaded')
@@ -170,19 +180,41 @@ class Register:
             self.logger.warning(f"Accession {accession} not found in {source}")
 
 
-    def filter_accessions(self, source: str, regexps: list[str]) -> list[str]:
+    def remove_accessions(self, source: str, accessions: Iterable[str]) -> None:
+        """
+        Removes several accessions from a source at once.
+
+        :param source: The source to remove the accessions from.
+        :param accessions: The accessions to remove. Accessions absent from the source are ignored.
         """
-        Returns the accessions from a given source that match at least one of the regexps.
+        if source not in self.acc_by_src:
+            self.logger.error(f"Source {source} not found in the register.")
+            return
+
+        size_before = len(self.acc_by_src[source])
+        self.acc_by_src[source].difference_update(accessions)
+        self.logger.info(f"{size_before - len(self.acc_by_src[source])} accessions removed from {source}")
+
+
+    def filter_accessions(self, source: str, pattern: re.Pattern | None) -> list[str]:
+        """
+        Returns the accessions from a given source that match the pattern.
 
         :param source: The source to filter.
-        :param regexps: A list of regular expressions.
-        :return:  A list of accessions from the source that match at least one of the regexps.
+        :param pattern: A compiled regular expression (or any object with a match method). Usually the union of several user regexps.
+                        If None, no accession is matching.
+        :return:  A list of accessions from the source that match the pattern.
         """
         if source not in self.acc_by_src:
             self.logger.error(f"Source {source} not found in the register.")
             return []
 
-        return [acc for acc in self.acc_by_src[source] if any(re.match(regexp, acc) for regexp in regexps)]
+        # Nothing to match: skip the regexp engine
+        if pattern is None or len(self.acc_by_src[source]) == 0:
+            return []
+
+        # filter calls the bound match method without a Python level loop
+        return list(filter(pattern.match, self.acc_by_src[source]))
 
 
     def __repr__(self) -> str:
@@ -215,15 +247,25 @@ def load_source(sourcepath: str) -> set[str]:
     return accessions
 
 
-def save_source(sourcepath: str, accessions: Iterable[str]) -> None:
+def save_source(sourcepath: str, accessions: Collection[str], skip_unchanged: bool = True) -> bool:
     """
 
     :param sourcepath: The path of this register corresponding a source
-    :param accessions: The list of accessions to write in sourcepath
+    :param accessions: The list of accessions to write in sourcepath.
+    :param skip_unchanged: If True and sourcepath already contains the same accessions, the file is not rewritten.
+                           Needs to read sourcepath back: set to False when the accessions are known to be modified.
+    :return: True if the file has been written, False if the write was skipped.
     """
+    # The saved accessions are only read back when saving: the read only commands do not pay for the comparison
+    if skip_unchanged and path.isfile(sourcepath):
+        saved = load_source(sourcepath)
+        if len(saved) == len(accessions) and saved.issuperset(accessions):
+            return False
+
     with open(sourcepath, 'w') as fw:
         for acc in accessions:
             print(acc, file=fw)
+    return True
 
 
 def create_register(dirpath: str, logger: logging.Logger, force: bool = False) -> Register:
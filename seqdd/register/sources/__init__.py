@@ -1,5 +1,6 @@
 import logging
 import abc
+from collections.abc import Collection, Iterable, Iterator
 from threading import Lock
 from ...utils.scheduler import Job
 
@@ -24,9 +25,12 @@ class Source(metaclass=abc.ABCMeta):
         self.mutex = Lock()
         """A lock object for thread synchronization."""
         self.last_query = 0
-        """The timestamp of the last query."""
+        """The time of the last query, on the time.monotonic clock."""
         self.min_delay = min_delay
         """The minimum delay between queries in seconds."""
+        self.max_threads = None
+        """The maximum number of threads used by a job of this source. None if unbounded.
+        Set by the download manager to its number of process slots."""
 
 
     @abc.abstractmethod
@@ -45,13 +49,25 @@ class Source(metaclass=abc.ABCMeta):
         pass
 
     @abc.abstractmethod
-    def jobs_from_accessions(self, accessions: list[str], datadir: str) -> list[Job]:
+    def filter_valid_accessions(self, accessions: Iterable[str]) -> Collection[str]:
         """
-        Generates a list of jobs for downloading and processing datasets.
+        Filters the given accessions and returns only the valid ones.
+        The accessions are only iterated, any collection can be given without copy.
 
-        :param accessions: A list of accessions for that source.
+        :param accessions: The accessions to validate.
+        :returns: The valid accessions.
+        """
+        pass
+
+    @abc.abstractmethod
+    def jobs_from_accessions(self, accessions: Collection[str], datadir: str) -> Iterator[Job]:
+        """
+        Generates the jobs for downloading and processing datasets.
+        The jobs are lazily created: the parents of a job are always generated before it.
+
+        :param accessions: The accessions for that source.
         :param datadir: The output directory path. Where the expected files will be located.
-        :returns: A list of jobs for downloading and processing datasets.
+        :returns: An iterator over the jobs for downloading and processing datasets.
         """
         pass
 
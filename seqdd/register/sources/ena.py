@@ -1,13 +1,23 @@
+import hashlib
 import logging
+from collections import deque
+from collections.abc import Callable, Collection, Iterable, Iterator
+from functools import partial
+from http.client import HTTPException
 from os import listdir, makedirs, path
 import re
+import string
 from shutil import rmtree, move
-import subprocess
 import time
+from typing import TypeVar
 
 from . import Source
 from ...utils.scheduler import Job, CmdLineJob, FunctionJob
 from ...errors import DownloadError
+from ...utils.http import HTTPClient
+
+
+T = TypeVar('T')
 
 
 naming = {
@@ -31,6 +41,24 @@ class ENA(Source):
         'Assembly': r'GCA_[0-9]{9}\.[0-9]+', #
         'Submission': r'(E|D|S)RA[0-9]{6,}'
     }
+    # All the patterns compiled once into a single regexp. The name of the matching group is the accession type.
+    accession_regexp = re.compile('|'.join(f'(?P<{acc_type}>{pattern})'
+                                           for acc_type, pattern in accession_patterns.items()))
+
+    accession_token = re.compile(rb'\b[A-Z]+_?[0-9]+(?:\.[0-9]+)?\b')
+    """Matches the accession like tokens in the raw ENA API answers."""
+    word_bytes = (string.ascii_letters + string.digits + '_.').encode()
+    """The bytes that can be part of an accession token (or glued to one)."""
+    chunk_size = 1 << 16
+    """The size of the chunks read from the ENA answers."""
+    query_timeout = 60
+    """The maximum time in seconds to wait for an ENA API answer."""
+    max_bisection_depth = 7
+    """The maximum number of times a rejected validation query is split in two (a 100 accessions query down to 1)."""
+    max_retries = 2
+    """The number of times a validation query is sent again after a server error (5xx) or a rate limit (429)."""
+    retry_delay = 5
+    """The delay in seconds before a query is sent again after a server error. Doubled at each retry."""
     
     
     def __init__(self, tmpdir: str, bindir: str, logger: logging.Logger) -> None:
@@ -43,6 +71,9 @@ class ENA(Source):
         """
         super().__init__(tmpdir, bindir, logger, min_delay=0.35)
 
+        self.http = HTTPClient(timeout=ENA.query_timeout)
+        """Persistent connections to the ENA servers. Only used while holding the mutex."""
+
 
     def is_ready(self) -> bool:
         """
@@ -61,9 +92,11 @@ class ENA(Source):
         locked = self.mutex.acquire(blocking=False)
         ready = False
         if locked:
-            ready = time.time() - self.last_query > self.min_delay
+            # Monotonic clock: the delay is not affected by system clock adjustments
+            now = time.monotonic()
+            ready = now - self.last_query > self.min_delay
             if ready:
-                self.last_query = time.time()
+                self.last_query = now
             self.mutex.release()
         return ready
     
@@ -76,27 +109,29 @@ class ENA(Source):
             The function acquires the mutex lock. You must release it after using this function.
 
         """
-        while not self.src_delay_ready():
-            time.sleep(0.01)
+        # Exclusive access to ENA, then sleep exactly the remaining delay (no polling)
         self.mutex.acquire()
+        remaining = self.min_delay - (time.monotonic() - self.last_query)
+        if remaining > 0:
+            time.sleep(remaining)
+        self.last_query = time.monotonic()
 
     
     # --- ENA Job creations ---
 
-    def jobs_from_accessions(self, accessions: list[str], datadir: str) -> list[Job]:
+    def jobs_from_accessions(self, accessions: Collection[str], datadir: str) -> Iterator[Job]:
         """
-        Generates a list of jobs for downloading and processing ENA datasets.
+        Generates the jobs for downloading and processing ENA datasets.
+        The FTP urls of an accession are only queried when its jobs are requested.
 
-        :param accessions: A list of ENA accessions.
+        :param accessions: The ENA accessions.
         :param datadir: The output directory path. Where the expected files will be located.
-        :returns: A list of jobs for downloading and processing ENA datasets.
+        :returns: An iterator over the jobs for downloading and processing ENA datasets.
         """
-        jobs = []
-
         # Checking already downloaded accessions
         downloaded_accessions = frozenset(listdir(datadir))
         
-        self.logger.info(f'Creating jobs for {len(accessions) - len(downloaded_accessions)} ENA accessions')
+        self.logger.info('Creating jobs for %d ENA accessions', len(accessions) - len(downloaded_accessions))
 
         # Each dataset download is independent
         for acc in accessions:
@@ -113,8 +148,7 @@ class ENA(Source):
 
             # Check if the accession is an assembly and create jobs accordingly
             if acc.startswith('GCA'):
-                jobs_from_assembly = self.jobs_from_assembly(acc, tmp_dir, datadir, job_name)
-                jobs.extend(jobs_from_assembly)
+                yield from self.jobs_from_assembly(acc, tmp_dir, datadir, job_name)
                 continue
 
             # Get file urls to download
@@ -136,18 +170,16 @@ class ENA(Source):
                     can_start = self.src_delay_ready,
                     name=f'{job_name}_{filename}'
                 ))
-            jobs.extend(curl_jobs)
+            yield from curl_jobs
             
             # Create a function job to move the files to the final directory
-            jobs.append(FunctionJob(
+            yield FunctionJob(
                 func_to_run = self.move_and_clean,
                 func_args = (tmp_dir, datadir, md5s),
                 parents = curl_jobs,
                 can_start = self.src_delay_ready,
                 name=f'{job_name}_move'
-            ))
-
-        return jobs
+            )
     
     def jobs_from_assembly(self, assembly: str, tmpdir: str, outdir: str, job_name: str) \
             -> list[Job]:
@@ -205,9 +237,8 @@ class ENA(Source):
             # Validate the MD5 hashes
             for filename, md5 in md5s.items():
                 file_path = path.join(accession_dir, filename)
-                md5_check = subprocess.run(['md5sum', file_path], stdout=subprocess.PIPE)
                 # Get the MD5 hash of the file
-                md5_hash = md5_check.stdout.decode().split()[0]
+                md5_hash = ENA.file_md5(file_path)
                 # Check if the MD5 hash is correct
                 if md5 != md5_hash:
                     msg = (f'MD5 hash mismatch for file {filename} in accession {accession_dir}.\n'
@@ -228,13 +259,32 @@ class ENA(Source):
         # Clean the directory
         rmtree(accession_dir)
 
+    @staticmethod
+    def file_md5(file_path: str, chunk_size: int = 1 << 20) -> str:
+        """
+        Computes the MD5 hash of a file in process (no md5sum subprocess).
+
+        :param file_path: The path of the file to hash.
+        :param chunk_size: The size of the chunks read from the file. Bounds the memory used.
+        :returns: The hexadecimal MD5 hash of the file.
+        """
+        md5 = hashlib.md5()
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        with open(file_path, 'rb', buffering=0) as fr:
+            # readinto reuses the same buffer for all the chunks
+            while (size := fr.readinto(buffer)) > 0:
+                md5.update(view[:size])
+        return md5.hexdigest()
+
+
     # --- ENA accession validity ---
     
-    def filter_valid_accessions(self, accessions: list[str]) -> list[str]:
+    def filter_valid_accessions(self, accessions: Iterable[str]) -> list[str]:
         """
-        Filters the given list of ENA accessions and returns only the valid ones.
+        Filters the given ENA accessions and returns only the valid ones.
 
-        :param accessions: A list of ENA accessions.
+        :param accessions: The ENA accessions.
         :returns: A list of valid ENA accessions.
         """
         accessions_by_type = dict()
@@ -256,8 +306,12 @@ class ENA(Source):
         return valid_accessions
 
 
-    def valid_accessions_on_API(self, accessions: list[str], query_size: int = 32) -> list[str]:
+    def valid_accessions_on_API(self, accessions: list[str], query_size: int = 100) -> list[str]:
         """
+        When ENA rejects a whole query, its slice is split in two halves queried separately.
+        A few bad accessions only cost a logarithmic number of extra queries instead of invalidating the slice.
+        Only the queries rejected because of their accessions (4xx) are split. After a server error (5xx)
+        or a rate limit (429), the query is sent again later, then its accessions are skipped (not validated).
 
         :param accessions: The accessions to test
         :param query_size: The maximum number of accessions to validate at one time.
@@ -267,36 +321,112 @@ class ENA(Source):
         query_begin = 'https://www.ebi.ac.uk/ena/browser/api/xml/'
         query_end = '?download=false&gzip=false&includeLinks=false'
 
-        for i in range(0, len(accessions), query_size):
-            slice = accessions[i:i+query_size]
+        # Worklist of the (slice, bisection depth, retries) to query. The halves of a rejected slice are queried next.
+        slices = deque((accessions[i:i+query_size], 0, 0) for i in range(0, len(accessions), query_size))
+        skipped = []
+        while slices:
+            slice, depth, retries = slices.popleft()
             query = f'{query_begin}{",".join(slice)}{query_end}'
-            # Wait for the delay
-            self.wait_my_turn()
-            # Query the ENA database
-            response = subprocess.run(['curl', query], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if response.returncode != 0:
-                self.logger.error(f'Error querying ENA\nQuery: {query}\nAnswer: {response.stderr.decode()}')
+            # Query the ENA database. The answer is scanned while it is received.
+            response = self.query_api_status(query, consume=ENA.scan_answer)
+            if response is None:
+                skipped.extend(slice)
+                continue
+            status, (error, found) = response
+
+            # Server side trouble: the accessions are not responsible. Splitting the query would only add load.
+            if status >= 500 or status == 429:
+                if retries < ENA.max_retries:
+                    time.sleep(ENA.retry_delay * 2 ** retries)
+                    slices.appendleft((slice, depth, retries + 1))
+                else:
+                    self.logger.error('ENA unavailable (status %d). %d accessions not validated.', status, len(slice))
+                    skipped.extend(slice)
                 continue
-            # Update the last query time
-            self.last_query = time.time()
-            self.mutex.release()
 
-            # Parse the response
-            response = response.stdout.decode()
-            if 'ErrorDetails' in response:
-                self.logger.error(f'Error querying ENA\nQuery: {query}\nAnswer: {response}')
+            if error is not None:
+                # ENA rejected the query: isolate the accessions responsible for the error
+                if len(slice) > 1 and depth < ENA.max_bisection_depth:
+                    mid = len(slice) // 2
+                    slices.appendleft((slice[mid:], depth + 1, 0))
+                    slices.appendleft((slice[:mid], depth + 1, 0))
+                else:
+                    self.logger.error('Error querying ENA\nQuery: %s\nAnswer: %s', query, error.decode())
                 continue
 
-            for acc in slice:
-                if acc in response:
-                    valid_accessions.append(acc)
+            # Exact matches: SRR1 is not validated by the presence of SRR12.
+            valid_accessions.extend(acc for acc in slice if acc.encode() in found)
 
-        invalid_accessions = set(accessions) - set(valid_accessions)
+        if len(skipped) > 0:
+            self.logger.warning('Accession(s) not validated, ENA could not be queried: %s', ', '.join(skipped))
+        invalid_accessions = set(accessions) - set(valid_accessions) - set(skipped)
         if len(invalid_accessions) > 0:
-            self.logger.warning(f'Accession(s) not found on ENA servers: {", ".join(invalid_accessions)}')
+            self.logger.warning('Accession(s) not found on ENA servers: %s', ', '.join(invalid_accessions))
 
         return valid_accessions
-    
+
+
+    def query_api(self, query: str, consume: Callable[[Iterable[bytes]], T] = b''.join) -> T | None:
+        """
+        Queries the ENA API in process, without spawning a curl subprocess.
+        The connection to the server is kept alive between the queries.
+        The minimum delay between ENA queries is respected.
+
+        :param query: The query url.
+        :param consume: Processes the chunks of the raw body while they are received.
+                        By default, the chunks are joined into the whole body.
+        :returns: The value returned by consume. None if the server cannot be reached.
+        """
+        response = self.query_api_status(query, consume)
+        return None if response is None else response[1]
+
+
+    def query_api_status(self, query: str, consume: Callable[[Iterable[bytes]], T] = b''.join) -> tuple[int, T] | None:
+        """
+        Queries the ENA API like query_api, and also gives the HTTP status of the answer.
+
+        :param query: The query url.
+        :param consume: Processes the chunks of the raw body while they are received.
+        :returns: A tuple (status, value returned by consume). None if the server cannot be reached.
+        """
+        # Wait for the delay
+        self.wait_my_turn()
+        try:
+            # Like curl, the body is given back for any status. The HTTP errors contain the ENA ErrorDetails.
+            with self.http.open('GET', query) as response:
+                return response.status, consume(iter(partial(response.read, ENA.chunk_size), b''))
+        except (HTTPException, OSError, ValueError) as e:
+            self.logger.error('Error querying ENA\nQuery: %s\nAnswer: %s', query, e)
+            return None
+        finally:
+            # Update the last query time
+            self.last_query = time.monotonic()
+            self.mutex.release()
+
+
+    @staticmethod
+    def scan_answer(chunks: Iterable[bytes]) -> tuple[bytes | None, set[bytes]]:
+        """
+        Scans an ENA answer chunk by chunk, without keeping the whole body in memory.
+
+        :param chunks: The successive chunks of the raw answer.
+        :returns: A tuple (error, tokens). error is the chunk containing the ENA ErrorDetails, None if there is no error.
+                  tokens is the set of accession like tokens in the answer.
+        """
+        error = None
+        tokens = set()
+        carry = b''
+        for chunk in chunks:
+            buffer = carry + chunk
+            if error is None and b'ErrorDetails' in buffer:
+                error = buffer
+            # The trailing word characters may be the beginning of a token continued in the next chunk
+            cut = len(buffer.rstrip(ENA.word_bytes))
+            tokens.update(ENA.accession_token.findall(buffer, 0, cut))
+            carry = buffer[cut:]
+        tokens.update(ENA.accession_token.findall(carry))
+        return error, tokens
+
 
     def validate_accession(self, accession: str) -> str:
         """
@@ -305,10 +435,10 @@ class ENA(Source):
         :param accession: The accession to validate.
         :returns: The type of accession if it is valid, otherwise the literal 'Invalid'.
         """
-        for accession_type, pattern in ENA.accession_patterns.items():
-            if re.fullmatch(pattern, accession):
-                return accession_type
-        self.logger.warning(f'Invalid accession: {accession}')
+        match = ENA.accession_regexp.fullmatch(accession)
+        if match is not None:
+            return match.lastgroup
+        self.logger.warning('Invalid accession: %s', accession)
         return 'Invalid'
     
 
@@ -321,46 +451,35 @@ class ENA(Source):
         """
         # Query the ENA API to get the FTP URL(s) for fastq files
         query = f'https://www.ebi.ac.uk/ena/browser/api/xml/{accession}?download=false&gzip=false&includeLinks=false'
-        self.wait_my_turn()
-        response = subprocess.run(['curl', query], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        # Update the last query time
-        self.last_query = time.time()
-        self.mutex.release()
+        response = self.query_api(query)
         # Check if the query was successful
-        if response.returncode != 0:
-            self.logger.error(f'Error querying ENA\nQuery: {query}\nAnswer: {response.stderr.decode()}')
+        if response is None:
             return []
         
         # Parse the response
-        response = response.stdout.decode()
+        response = response.decode()
         # Get the url for submitted files
         match = re.search(r'<ID><!\[CDATA\[(https?://[^\]]+submitted_ftp[^\]]*)\]\]></ID>', response)
         if not match:
-            self.logger.error(f'No submitted files found for accession {accession}')
+            self.logger.error('No submitted files found for accession %s', accession)
             return []
         
         # Get the file list from the URL
         submitted_url = match.group(1)
-        self.wait_my_turn()
-        response = subprocess.run(['curl', submitted_url], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        # Update the last query time
-        self.last_query = time.time()
-        self.mutex.release()
+        response = self.query_api(submitted_url)
         # Check if the query was successful
-        if response.returncode != 0:
-            self.logger.error(f'Error querying ENA\nQuery: {submitted_url}\nAnswer: {response.stderr.decode()}')
+        if response is None:
             return []
         
         # Parse the response
-        lines = response.stdout.decode().strip().split('\n')
+        lines = response.decode().strip().split('\n')
         if len(lines) < 2:
             return []
 
         # Get the header
         header = lines[0].split()
         if 'submitted_ftp' not in header or 'submitted_md5' not in header:
-            self.logger.error(f'No submitted files found for accession {accession}')
+            self.logger.error('No submitted files found for accession %s', accession)
             return []
         
         files = []
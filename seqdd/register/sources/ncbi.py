@@ -1,15 +1,20 @@
 import logging
-import platform
-import time
-import json
+import re
 import subprocess
-import threading
-from os import listdir, makedirs, path
-from shutil import rmtree, move
+from collections.abc import Collection, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from os import chmod, environ, makedirs, path, remove, rename, rmdir, scandir, stat, uname
+from http.client import HTTPException
+from shutil import copyfileobj, rmtree
+from tempfile import NamedTemporaryFile
+from urllib.request import urlopen
+from zipfile import ZipFile
 
 from . import Source
 from ...utils.scheduler import Job, CmdLineJob, FunctionJob
-from ...utils.download import check_binary
+from ...utils.download import check_binary, move_entry
+from ...utils.ratelimit import RateLimiter
 
 # GCA_003774525.2 GCA_015190445.1 GCA_01519
 
@@ -25,7 +30,33 @@ class NCBI(Source):
     The NCBI class represents a data downloader for the National Center for Biotechnology Information (NCBI) database.
     """
 
-    ncbi_joib_id = 0
+    default_rate = 1
+    """The maximum number of NCBI queries per second."""
+    api_key_rate = 10
+    """The maximum number of NCBI queries per second with an API key (NCBI allows 10 queries per second)."""
+    install_timeout = 60
+    """The maximum time in seconds to wait for the server when installing the datasets binary."""
+    software_paths = {}
+    """The path of the download software found for each binary directory."""
+    job_ids = count()
+    """Unique job identifiers. next() on a count is atomic, concurrent job generations cannot share an id."""
+
+    max_parallel_queries = 4
+    """The maximum number of validation queries running at the same time."""
+    accessions_per_query = 500
+    """The number of accessions validated by a single datasets process."""
+    download_batch_size = 50
+    """The number of accessions downloaded by the same job chain.
+    Accessions have a fixed size: the command lines stay far below the system limit."""
+    staging_dirname = '.seqdd_tmp'
+    """The staging directory created in the destination when the temporary directory is on another file system.
+    Removed once all the downloads are over."""
+    max_parallel_moves = 4
+    """The maximum number of datasets moved at the same time to their final directory."""
+    accession_format = re.compile(r'GC[AF]_[0-9]{9}\.[0-9]+')
+    """The format of the NCBI assembly accessions (see is_valid_acc_format)."""
+    accession_field = re.compile(rb'"accession"\s*:\s*"([^"]+)"')
+    """Extracts the accession values from a json report."""
 
 
     def __init__(self, tmpdir: str, bindir: str, logger: logging.Logger) -> None:
@@ -36,7 +67,18 @@ class NCBI(Source):
         :param bindir: The binary directory path.
         :param logger: The logger object for logging messages.
         """
-        super().__init__(tmpdir, bindir, logger)
+        # NCBI allows more queries per second to the API key owners.
+        # The datasets processes inherit the environment: they send the key by themselves.
+        api_key = environ.get('NCBI_API_KEY')
+        rate = NCBI.api_key_rate if api_key else NCBI.default_rate
+        super().__init__(tmpdir, bindir, logger, min_delay=1 / rate)
+        # The starts are spaced by 1 / rate. All the validation threads can have a query running.
+        self.limiter = RateLimiter(rate, max_inflight=NCBI.max_parallel_queries)
+        """Limits the NCBI queries of all the jobs and validation threads of this source."""
+        if api_key:
+            logger.info('NCBI API key found in NCBI_API_KEY. Up to %d NCBI queries per second', rate)
+        else:
+            logger.debug('No NCBI_API_KEY set. Up to %d NCBI query per second', rate)
 
         self.bin = self.get_download_software()
         """The path to the NCBI download software."""
@@ -53,111 +95,160 @@ class NCBI(Source):
 
     def src_delay_ready(self) -> bool:
         """
-        Checks if the minimum delay between NCBI queries has passed.
-
-        :return: True if the delay has passed, False otherwise.
-        """
-        # Minimal delay between ncbi queries (1s)
-        min_delay = 1
-        locked = self.mutex.acquire(blocking=False)
-        ready = False
-        if locked:
-            # 5s since the last query ?
-            ready = time.time() - self.last_query > min_delay
-            if ready:
-                self.last_query = time.time()
-            self.mutex.release()
-        return ready
-
-
-    def wait_ncbi_delay(self) -> threading.Lock:
-        """
-        Wait for the NCBI ressource to be available (some delay between queries must be waited).
-        Once the delay has passed, it acquires a mutex lock to ensure that no other operation is queriing instead.
+        Checks if a NCBI query can start now, according to the NCBI rate limit.
 
-        :return: The NCBI query lock.
+        :return: True if the query can start, False otherwise.
         """
-        while not self.src_delay_ready():
-            time.sleep(time.time() - self.last_query)
-
-        self.mutex.acquire()
-        return self.mutex
+        # Only the query start is reserved: the downloads run for long and are not counted as running queries
+        return self.limiter.try_acquire()
 
 
-    def jobs_from_accessions(self, accessions: list[str], dest_dir: str) -> list[Job]:
+    def jobs_from_accessions(self, accessions: Collection[str], dest_dir: str) -> Iterator[Job]:
         """
-        Generates a list of jobs for downloading and processing accessions.
+        Generates the jobs for downloading and processing accessions.
 
         :param accessions: The list of accessions to download.
         :param dest_dir: The destination directory path.
-        :return: A list of jobs for downloading and processing accessions.
+        :return: An iterator over the jobs for downloading and processing accessions.
         """
-        accessions = list(accessions)
-        all_jobs = []
-
-        # Download accessions by batch of 5
-        for idx in range(0, len(accessions), 5):
-            # Create a temporary directory for the current job
-            tmp_dir = path.join(self.tmp_dir, f'ncbi_{NCBI.ncbi_joib_id}')
-            makedirs(tmp_dir, exist_ok=True)
+        # Skip the datasets already present in the destination (one directory per accession)
+        try:
+            with scandir(dest_dir) as entries:
+                downloaded = {entry.name for entry in entries if entry.is_dir()}
+        except FileNotFoundError:
+            downloaded = set()
+        requested = dict.fromkeys(accessions)
+        accessions = [acc for acc in requested if acc not in downloaded]
+        if len(accessions) < len(requested):
+            self.logger.info('%d NCBI datasets already present in %s. Skipping them.',
+                             len(requested) - len(accessions), dest_dir)
+        if len(accessions) == 0:
+            return
+        # All the jobs share the temporary directory, their files are prefixed by their job names
+        tmp_dir = self.staging_dir(dest_dir)
+
+        # Download accessions by batch. Each batch costs 2 datasets processes (download + rehydrate).
+        batch_size = NCBI.download_batch_size
+        reorg_jobs = []
+        for idx in range(0, len(accessions), batch_size):
             # Job name
-            job_name = f'ncbi_job_{NCBI.ncbi_joib_id}'
-            NCBI.ncbi_joib_id += 1
+            job_name = f'ncbi_job_{next(NCBI.job_ids)}'
 
-            # Take the right slice of 5 accessions
-            acc_slice = accessions[idx:idx+5]
+            # Take the right slice of accessions
+            acc_slice = accessions[idx:idx+batch_size]
 
             # Download dehydrated job
             download_file = path.join(tmp_dir, f'{job_name}.zip')
-            download_job = CmdLineJob(f"{self.bin} download genome accession --dehydrated --no-progressbar "
-                                      f"--filename {download_file} {' '.join(acc_slice)}",
+            download_job = CmdLineJob([self.bin, 'download', 'genome', 'accession', '--dehydrated', '--no-progressbar',
+                                       '--filename', download_file, *acc_slice],
                                       can_start=self.src_delay_ready,
                                       name=f'{job_name}_download')
             
             # Unzip Job
             unzip_dir = path.join(tmp_dir, job_name)
-            unzip_job = CmdLineJob(f"unzip -n {download_file} -d {unzip_dir}",
-                                   parents=[download_job],
-                                   name=f'{job_name}_unzip')
+            unzip_job = FunctionJob(NCBI.unzip,
+                                    func_args=(download_file, unzip_dir),
+                                    parents=[download_job],
+                                    name=f'{job_name}_unzip')
 
             # Data download
-            rehydrate_job = CmdLineJob(f"{self.bin} rehydrate --gzip --no-progressbar --directory {unzip_dir}",
+            rehydrate_job = CmdLineJob([self.bin, 'rehydrate', '--gzip', '--no-progressbar', '--directory', unzip_dir],
                                        parents=[unzip_job],
                                        can_start=self.src_delay_ready,
                                        name=f'{job_name}_rehydrate')
 
             # Data reorganization
             reorg_job = FunctionJob(self.clean,
-                                    func_args=(unzip_dir, dest_dir, tmp_dir),
+                                    func_args=(unzip_dir, dest_dir, download_file),
                                     parents=[rehydrate_job],
                                     name=f'{job_name}_clean')
 
-            all_jobs.extend([download_job, unzip_job, rehydrate_job, reorg_job])
+            reorg_jobs.append(reorg_job)
+            yield from (download_job, unzip_job, rehydrate_job, reorg_job)
+
+        # A staging directory in the destination is removed once all the batches are over
+        if tmp_dir != self.tmp_dir:
+            yield FunctionJob(self.remove_staging_dir,
+                              func_args=(tmp_dir,),
+                              parents=reorg_jobs,
+                              name=f'ncbi_job_{next(NCBI.job_ids)}_staging_cleanup')
+
+
+    def staging_dir(self, dest_dir: str) -> str:
+        """
+        Chooses the directory where the genomes are downloaded before being moved to their destination.
+        The temporary directory is used if it is on the same file system as the destination: the final moves are renames.
+        Otherwise, the genomes are staged in a hidden directory of the destination (staging_dirname), to avoid
+        copying them. This directory is removed by the last job of the downloads, if it is empty
+        (see remove_staging_dir). Files left by failed jobs are kept for inspection.
+
+        :param dest_dir: The destination directory path.
+        :return: The staging directory path, created if needed.
+        """
+        makedirs(self.tmp_dir, exist_ok=True)
+        makedirs(dest_dir, exist_ok=True)
+        if stat(self.tmp_dir).st_dev == stat(dest_dir).st_dev:
+            return self.tmp_dir
+
+        staging = path.join(dest_dir, NCBI.staging_dirname)
+        self.logger.info('%s is not on the same file system as %s. The NCBI genomes are downloaded in %s.',
+                         self.tmp_dir, dest_dir, staging)
+        makedirs(staging, exist_ok=True)
+        return staging
+
+
+    def remove_staging_dir(self, staging: str) -> None:
+        """
+        Removes the staging directory of the destination if it is empty.
+
+        :param staging: The staging directory path.
+        """
+        try:
+            rmdir(staging)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # Not empty: the files of a failed job
+            self.logger.warning('%s is not empty. Kept for inspection.', staging)
+
+
+    @staticmethod
+    def unzip(archive: str, unzip_dir: str) -> None:
+        """
+        Extracts a dehydrated NCBI archive with the zipfile module (no unzip binary needed).
 
-        return all_jobs
+        :param archive: The path of the zip archive.
+        :param unzip_dir: The directory where the archive content is extracted.
+        """
+        with ZipFile(archive) as zf:
+            zf.extractall(unzip_dir)
 
 
-    def clean(self, unzip_dir: str, dest_dir: str, tmp_dir: str) -> None:
+    def clean(self, unzip_dir: str, dest_dir: str, download_file: str) -> None:
         """
         Cleans up the downloaded files and moves them to the destination directory.
 
         :param unzip_dir: The directory path where the files are unzipped.
         :param dest_dir: The destination directory path.
-        :param tmp_dir: The temporary directory path.
+        :param download_file: The path of the downloaded archive.
         """
         # Remove subdirectories while moving their content
         data_dir = path.join(unzip_dir, "ncbi_dataset", "data")
 
-        # Enumerated the downloaded files
-        for subname in listdir(data_dir):
-            subpath = path.join(data_dir, subname)
-            # Looks only for datasets
-            if path.isdir(subpath):
-                # Move the directory and its content to the final directory
-                move(subpath, path.join(dest_dir, subname))
+        # Enumerated the downloaded datasets (scandir knows the entry types without a stat per entry)
+        with scandir(data_dir) as entries:
+            datasets = [entry for entry in entries if entry.is_dir()]
+
+        # Move the directories and their content to the final directory.
+        # On the same file system a move is a single rename. Across file systems it is a copy: the datasets are copied concurrently.
+        with ThreadPoolExecutor(max_workers=NCBI.max_parallel_moves) as executor:
+            moves = [executor.submit(move_entry, entry.path, path.join(dest_dir, entry.name)) for entry in datasets]
+            for future in moves:
+                future.result()
 
-        # Clean the download directory
-        rmtree(tmp_dir)
+        # Clean the job files
+        remove(download_file)
+        rmtree(unzip_dir)
 
 
     @staticmethod
@@ -173,76 +264,100 @@ class NCBI(Source):
         :param acc: The accession number to validate.
         :return: True if the accession number is in a valid format, False otherwise.
         """
-        if not (acc.startswith('GCA_') or acc.startswith('GCF_')):
-            return False
+        return NCBI.accession_format.fullmatch(acc) is not None
 
-        acc = acc[4:]
-        if '.' not in acc:
-            return False
-        
-        id, version = acc.split('.')
-        if len(id) != 9 or not id.isdigit() or not version.isdigit():
-            return False
-        
-        return True
-    
 
-    def filter_valid_accessions(self, accessions: set[str]) -> set[str]:
+    def filter_valid_accessions(self, accessions: Iterable[str]) -> set[str]:
         """
         Filters and validates a list of accessions.
 
-        :param accessions: The set of accessions to filter and validate.
+        :param accessions: The accessions to filter and validate.
         :return: The set of valid accessions.
         """
-        accessions_list = [acc for acc in accessions if self.is_valid_acc_format(acc)]
-        invalid_accessions = list(accessions - set(accessions_list))
+        # Deduplicated while keeping the user order: an accession is queried only once
+        accessions_list = []
+        invalid_accessions = []
+        for acc in dict.fromkeys(accessions):
+            if self.is_valid_acc_format(acc):
+                accessions_list.append(acc)
+            else:
+                invalid_accessions.append(acc)
         if len(invalid_accessions) > 0:
-            self.logger.warning(f'Wrong format accessions: {", ".join(invalid_accessions)}. '
-                                f'Expectiing GCA_XXXXXXXXX.Y or GCF_XXXXXXXXX.Y')
+            self.logger.warning('Wrong format accessions: %s. Expectiing GCA_XXXXXXXXX.Y or GCF_XXXXXXXXX.Y',
+                                ', '.join(invalid_accessions))
+
+        # Each query costs a process launch and a TLS handshake: few large slices are cheaper than many small ones
+        accessions_per_query = NCBI.accessions_per_query
+        slices = [accessions_list[idx:idx+accessions_per_query]
+                  for idx in range(0, len(accessions_list), accessions_per_query)]
 
         valid_accessions = set()
         unknown_accessions = set()
-        accessions_per_query = 32
-
-        for idx in range(0, len(accessions), accessions_per_query):
-            slice = accessions_list[idx:idx+accessions_per_query]
-
-            # Query the NCBI to check if the accessions are valid
-            cmd = f'{self.bin} summary genome accession {" ".join(slice)}'
-            lock = self.wait_ncbi_delay()
-            ret = subprocess.run(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            lock.release()
-
-            if ret.returncode != 0:
-                self.logger.error(f'Failed to query NCBI for accessions: {", ".join(slice)}')
-                continue
-
-            # parse the json from the stout of the subprocess
-            slice_set = set(slice)
-            try:
-                data = json.loads(ret.stdout)
-                if 'reports' in data:
-                    # Update accessions returned
-                    for acc_obj in data['reports']:
-                        acc = acc_obj['accession']
-                        if acc in slice_set:
-                            valid_accessions.add(acc)
-                            slice_set.remove(acc)
-
-                # Update unknown accessions
-                unknown_accessions.update(slice_set)
-            except json.JSONDecodeError:
-                self.logger.error(f'Failed to parse the json response from NCBI for accessions: {", ".join(slice)}')
+        # The queries are network bound: the threads wait for NCBI, not for the GIL
+        with ThreadPoolExecutor(max_workers=NCBI.max_parallel_queries) as executor:
+            for valid, unknown in executor.map(self.query_summary, slices):
+                valid_accessions |= valid
+                unknown_accessions |= unknown
 
         if len(unknown_accessions) > 0:
-            self.logger.warning(f'Unknown accessions: {", ".join(unknown_accessions)}')
+            self.logger.warning('Unknown accessions: %s', ', '.join(unknown_accessions))
 
         return valid_accessions
     
 
+    def query_summary(self, accessions: list[str]) -> tuple[set[str], set[str]]:
+        """
+        Queries the NCBI summary of a slice of accessions.
+
+        :param accessions: The accessions to query.
+        :return: The valid accessions and the unknown accessions. Both are empty if the query failed.
+        """
+        # Query the NCBI to check if the accessions are valid.
+        # Only the identifiers are needed: the full reports are much larger to transfer and to parse.
+        # The accessions are given in a file (no command line length limit) and the reports are read line by line.
+        makedirs(self.tmp_dir, exist_ok=True)
+        with NamedTemporaryFile('w', dir=self.tmp_dir, prefix='ncbi_summary_', suffix='.txt') as fw:
+            fw.write('\n'.join(accessions))
+            fw.flush()
+            cmd = [self.bin, 'summary', 'genome', 'accession', '--inputfile', fw.name,
+                   '--report', 'ids_only', '--as-json-lines']
+            # Scan each report for its accession field instead of decoding it.
+            # Other identifiers of the reports (paired, current accessions) are under other keys.
+            with self.limiter, subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+                returned = {match.decode() for line in process.stdout
+                            for match in NCBI.accession_field.findall(line)}
+
+        if process.returncode != 0:
+            self.logger.error('Failed to query NCBI for accessions: %s', ', '.join(accessions))
+            return set(), set()
+
+        slice_set = set(accessions)
+        valid_accessions = slice_set & returned
+        slice_set -= valid_accessions
+
+        return valid_accessions, slice_set
+
+
     def get_download_software(self) -> str|None:
         """
         Checks if the NCBI download software is installed and returns the path.
+        The path is resolved once per binary directory and shared by all the NCBI instances.
+
+        :return: The path to the NCBI download software, or None if it is not installed.
+        """
+        key = path.abspath(self.bin_dir)
+        if key not in NCBI.software_paths:
+            software = self.find_download_software()
+            # Failures are not cached: the next instance tries again
+            if software is None:
+                return None
+            NCBI.software_paths[key] = software
+        return NCBI.software_paths[key]
+
+
+    def find_download_software(self) -> str|None:
+        """
+        Looks for the NCBI download software on the system then in the binary directory. Installs it if missing.
 
         :return: The path to the NCBI download software, or None if it is not installed.
         """
@@ -270,9 +385,9 @@ class NCBI(Source):
         download_link = ''
         supported = True
 
-        system = platform.system()
+        system = uname().sysname
         if system == 'Linux':
-            cpu_type = platform.machine()
+            cpu_type = uname().machine
             if cpu_type in ['i386', 'i686', 'x86_64', 'x86', 'AMD64']:
                 download_link = 'https://ftp.ncbi.nlm.nih.gov/pub/datasets/command-line/v2/linux-amd64/datasets'
             elif cpu_type in ['aarch64_be', 'aarch64', 'armv8b', 'armv8l', 'arm']:
@@ -287,7 +402,7 @@ class NCBI(Source):
             self.logger.error(f'ncbi datasets auto-install is not yet supported on your system. '
                               f'Plese install ncbi datasets cli by yourself. '
                               f'Also maybe we can include your system in the auto-installer. '
-                              f'Please submit an issue on github with the following values:\nsystem={system}\tplateform={platform.machine()}')
+                              f'Please submit an issue on github with the following values:\nsystem={system}\tplateform={uname().machine}')
             return None
 
         # Download datasets
@@ -297,27 +412,27 @@ class NCBI(Source):
         download_dir = path.abspath(self.bin_dir)
         makedirs(download_dir, exist_ok=True)
         
-        # Download...
-        cmd = f'curl -o {path.join(download_dir, "datasets")} {download_link}'
-        ret = subprocess.run(cmd.split(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        if ret.returncode == 0:
-            binpath = path.join(download_dir, 'datasets')
-
-            ret = subprocess.run(f'chmod +x {binpath}'.split())
-            if ret.returncode == 0:
-                # move the binary to the bin directory
-                final_path = path.abspath(path.join(self.bin_dir, 'datasets'))
-                move(binpath, final_path)
-                self.logger.info(f'ncbi datasets cli installed at {final_path}')
-
-                return f'{final_path}'
-            else:
-                # Failed to set executable permissions
-                self.logger.error(f'Failed to set executable permissions for ncbi datasets cli: {binpath}')
-        else:
+        # Download in a temporary file: an interrupted download never looks like an installed binary
+        binpath = path.join(download_dir, 'datasets')
+        partial_path = f'{binpath}.part'
+        try:
+            with urlopen(download_link, timeout=NCBI.install_timeout) as response, open(partial_path, 'wb') as fw:
+                copyfileobj(response, fw, 1 << 20)
+        except (HTTPException, OSError) as e:
             # Failed to download ncbi datasets cli
-            self.logger.error(f'Failed to download ncbi datasets cli from: {download_link}')
+            self.logger.error('Failed to download ncbi datasets cli from: %s (%s)', download_link, e)
+            if path.exists(partial_path):
+                remove(partial_path)
+            return None
+
+        try:
+            chmod(partial_path, 0o755)
+            rename(partial_path, binpath)
+        except OSError:
+            # Failed to set executable permissions
+            self.logger.error('Failed to set executable permissions for ncbi datasets cli: %s', binpath)
+            return None
 
-        return None
+        self.logger.info('ncbi datasets cli installed at %s', binpath)
+        return binpath
     
\ No newline at end of file
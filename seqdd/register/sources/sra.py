@@ -1,12 +1,13 @@
 import logging
-import platform
+from collections.abc import Collection, Iterable, Iterator
+import shlex
 import subprocess
-import time
-from os import listdir, makedirs, path, remove
-from shutil import rmtree, move
+from os import makedirs, path, remove, scandir, uname
+from shutil import rmtree
 
 from . import Source
-from ...utils.download import check_binary
+from ...utils.download import check_binary, drop_page_cache, move_entry
+from ...utils.ratelimit import RateLimiter
 from ...utils.scheduler import Job, CmdLineJob, FunctionJob
 
 
@@ -22,6 +23,14 @@ class SRA(Source):
     The SRA class represents a data downloader for the Sequence Read Archive (SRA) database.
     """
 
+    toolkits = {}
+    """The binaries found for each binary directory."""
+    threads = 4
+    """The number of threads used by each multithreaded tool (fasterq-dump, pigz).
+    The extraction jobs take as many process slots in the scheduler. Set it to 1 to run the tools single threaded."""
+    query_rate = 2
+    """The maximum number of SRA queries per second."""
+
 
     def __init__(self, tmpdir: str, bindir: str, logger: logging.Logger) -> None:
         """
@@ -31,10 +40,12 @@ class SRA(Source):
         :param bindir: The binary directory path. Where the helper binaries tools are stored.
         :param logger: The logger object.
         """
-        super().__init__(tmpdir, bindir, logger, min_delay=0.5)
+        super().__init__(tmpdir, bindir, logger, min_delay=1 / SRA.query_rate)
+        self.limiter = RateLimiter(SRA.query_rate)
+        """Limits the SRA queries of all the jobs of this source."""
 
         self.binaries = self.download_sra_toolkit()
-        """A dictionary containing the paths to the SRA toolkit binaries."""
+        """A dictionary containing the paths to the SRA toolkit binaries and to the gzip compressor."""
 
 
     def is_ready(self) -> bool:
@@ -48,47 +59,46 @@ class SRA(Source):
 
     def src_delay_ready(self) -> bool:
         """
-        Checks if the minimum delay between SRA queries has passed.
+        Checks if a SRA query can start now, according to the SRA rate limit.
 
-        :return: True if the minimum delay has passed, False otherwise.
+        :return: True if the query can start, False otherwise.
         """
-        # Minimal delay between SRA queries (0.5s)
-        locked = self.mutex.acquire(blocking=False)
-        ready = False
-        if locked:
-            ready = time.time() - self.last_query > self.min_delay
-            if ready:
-                self.last_sra_query = time.time()
-            self.mutex.release()
-        return ready
-
-
-    def filter_valid_accessions(self, accessions: list[str]) -> list[str]:
+        # The prefetch jobs only need their start to be spaced: they are not counted as running queries
+        return self.limiter.try_acquire()
+
+
+    def filter_valid_accessions(self, accessions: Iterable[str]) -> list[str]:
         """
-        Filters the given list of SRA accessions and returns only the valid ones.
+        Filters the given SRA accessions and returns only the valid ones.
 
-        :param accessions: A list of SRA accessions.
+        :param accessions: The SRA accessions.
         :return: A list of valid SRA accessions.
         """
         # TODO: Validate sra accessions
-        return accessions
+        return list(accessions)
 
     
-    def jobs_from_accessions(self, accessions: list[str], datadir: str) -> list[Job]:
+    def jobs_from_accessions(self, accessions: Collection[str], datadir: str) -> Iterator[Job]:
         """
-        Generates a list of jobs for downloading and processing SRA datasets.
+        Generates the jobs for downloading and processing SRA datasets.
 
         :param accessions: A list of SRA accessions.
         :param datadir: The output directory path.
-        :return: A list of jobs for downloading and processing SRA datasets.
+        :return: An iterator over the jobs for downloading and processing SRA datasets.
         """
-        jobs = []
+
+        # The datasets already downloaded, listed once instead of a path check per accession
+        try:
+            with scandir(datadir) as entries:
+                downloaded = frozenset(entry.name for entry in entries)
+        except FileNotFoundError:
+            downloaded = frozenset()
 
         # Each dataset download is independent
         for acc in accessions:
             # Do not download an already downloaded dataset
-            if path.exists(path.join(datadir, acc)):
-                self.logger.info(f'{acc} already downloaded. Skipping...')
+            if acc in downloaded:
+                self.logger.info('%s already downloaded. Skipping...', acc)
                 continue
 
             # Create a job name based on the accession
@@ -106,32 +116,23 @@ class SRA(Source):
             fasterq_dump_jobs = []
             if acc.startswith('SRR'):
                 # Prefetch data
-                cmd = f'{self.binaries["prefetch"]} --max-size u --output-directory {self.tmp_dir} {acc}'
+                cmd = f'{shlex.quote(self.binaries["prefetch"])} --max-size u --output-directory {shlex.quote(self.tmp_dir)} {shlex.quote(acc)}'
                 prefetch_job = CmdLineJob(cmd, can_start=self.src_delay_ready, name=f'{job_name}_prefetch')
                 # Download SRR accession
-                fasterq_dump_jobs = self.jobs_from_SRR(acc_dir, job_name)
+                fasterq_dump_jobs = self.jobs_from_SRR(acc_dir, job_name, datadir)
             elif acc.startswith('SRX') or acc.startswith('SRP'):
                 # Prefetch data
-                cmd = f'{self.binaries["prefetch"]} --max-size u --output-directory {acc_dir} {acc}'
+                cmd = f'{shlex.quote(self.binaries["prefetch"])} --max-size u --output-directory {shlex.quote(acc_dir)} {shlex.quote(acc)}'
                 prefetch_job = CmdLineJob(cmd, can_start=self.src_delay_ready, name=f'{job_name}_prefetch')
-                fasterq_dump_jobs = self.jobs_from_SRXP(acc_dir, job_name)
+                fasterq_dump_jobs = self.jobs_from_SRXP(acc_dir, job_name, datadir)
 
             # define parents
             for job in fasterq_dump_jobs:
                 job.parents.append(prefetch_job)
 
-            # Move to datadir and clean tmp_dir
-            clean_job = FunctionJob(self.move_and_clean,
-                                    func_args=(acc_dir, datadir),
-                                    parents=fasterq_dump_jobs,
-                                    name=f'{job_name}_clean')
-
-            # Set the jobs
-            jobs.append(prefetch_job)
-            jobs.extend(fasterq_dump_jobs)
-            jobs.append(clean_job)
-
-        return jobs
+            # Set the jobs. The last extraction job moves the files to datadir and cleans tmp_dir.
+            yield prefetch_job
+            yield from fasterq_dump_jobs
     
 
     def move_and_clean(self, accession_dir: str, outdir: str) -> None:
@@ -146,12 +147,16 @@ class SRA(Source):
         outdir = path.join(outdir, accession)
         makedirs(outdir, exist_ok=True)
 
-        # Enumerate all the files from the accession directory
-        for node in listdir(accession_dir):
-            nodepath = path.join(accession_dir, node)
-            # Move SRR accession files
-            if path.isfile(nodepath) and node.endswith('.gz'):
-                move(path.join(accession_dir, node), path.join(outdir, node))
+        # Enumerate all the files from the accession directory (scandir knows their types without a stat)
+        with scandir(accession_dir) as entries:
+            compressed = [entry for entry in entries if entry.name.endswith('.gz') and entry.is_file()]
+        # Move SRR accession files
+        for entry in compressed:
+            # A single rename when the temporary and output directories share a file system
+            filepath = path.join(outdir, entry.name)
+            move_entry(entry.path, filepath)
+            # The file pages cached during the compression would evict more useful data
+            drop_page_cache(filepath)
 
         # Clean the directory
         rmtree(accession_dir)
@@ -159,63 +164,78 @@ class SRA(Source):
 
     # ---- SRA specific jobs ----
 
-    def jobs_from_SRR(self, accession_dir: str, job_name: str) -> list[Job]:
+    def jobs_from_SRR(self, accession_dir: str, job_name: str, datadir: str) -> list[Job]:
         """
 
         :param accession_dir:
         :param job_name:
+        :param datadir: The output directory path.
         :return:
         """
-        # Split files
-        cmd = f'{self.binaries["fasterq-dump"]} --split-3 --skip-technical --outdir {accession_dir} {accession_dir}'
-        fasterqdump_job = CmdLineJob(cmd, can_start=self.src_delay_ready, name=f'{job_name}_fasterqdump')
-        
-        # Compress files
-        cmd = f'gzip {path.join(accession_dir, "*.fastq")}'
-        compress_job = CmdLineJob(cmd, parents=[fasterqdump_job], name=f'{job_name}_compress')
-
-        return [fasterqdump_job, compress_job]
+        # Split files then compress them in the same job: the fastq files are compressed as soon as they are
+        # written, while they are still in the page cache. --split-3 needs files (--stdout would mix the mates).
+        # The prefetched data is local: the job does not query the SRA and is not gated by the query delay.
+        # The prefetch directory is given (not the accession) so the data is not fetched again. It also holds
+        # the fasterq-dump scratch files, which default to the current directory.
+        # The paths are quoted for the shell. Only the fastq glob is left to the shell expansion.
+        quoted_dir = shlex.quote(accession_dir)
+        threads = self.job_threads()
+        cmd = (f'{shlex.quote(self.binaries["fasterq-dump"])} --split-3 --skip-technical --threads {threads} '
+               f'--temp {quoted_dir} --outdir {quoted_dir} {quoted_dir}'
+               f' && {self.gzip_command()} {quoted_dir}/*.fastq')
+        fasterqdump_job = CmdLineJob(cmd, name=f'{job_name}_fasterqdump+gzip', cpu_cost=threads)
+        # Then move the compressed files to datadir and clean tmp_dir
+        move_job = FunctionJob(self.move_and_clean, func_args=(accession_dir, datadir),
+                               parents=[fasterqdump_job], name=f'{job_name}_move')
+
+        return [fasterqdump_job, move_job]
     
 
-    def jobs_from_SRXP(self, acc_dir: str, job_name: str) -> list[Job]:
+    def jobs_from_SRXP(self, acc_dir: str, job_name: str, datadir: str) -> list[Job]:
         """
 
         :param acc_dir:
         :param job_name:
+        :param datadir: The output directory path.
         :return:
         """
         SRXP_subjob = FunctionJob(
             self.run_fasterqdump_from_SRXP,
-            func_args=(acc_dir,),
-            name=f'{job_name}_fasterqdump+gzip'
+            func_args=(acc_dir, datadir),
+            name=f'{job_name}_fasterqdump+gzip',
+            cpu_cost=self.job_threads()
         )
 
         return [SRXP_subjob]
     
 
-    def run_fasterqdump_from_SRXP(self, SRXP_directory: str) -> None:
+    def run_fasterqdump_from_SRXP(self, SRXP_directory: str, datadir: str) -> None:
         """
+        Extracts and compresses the runs of an experiment or a project, then moves them to datadir.
 
         :param SRXP_directory:
+        :param datadir: The output directory path.
         """
         # TODO: Move log files to the log directory. Can be done after yielding.
         SRX_name = path.basename(SRXP_directory)
 
-        for subdirectory_name in listdir(SRXP_directory):
-            subdirectory = path.join(SRXP_directory, subdirectory_name)
+        with scandir(SRXP_directory) as entries:
             # Verify that is a run subdirectory
-            if (not path.isdir(subdirectory)) or (not subdirectory_name.startswith('SRR')):
-                continue
+            runs = [entry for entry in entries if entry.name.startswith('SRR') and entry.is_dir()]
+
+        for run in runs:
+            subdirectory, subdirectory_name = run.path, run.name
             
             res = None
             log_file = path.join(self.tmp_dir, f'{SRX_name}_{subdirectory_name}_fasterq-dump.log')
             
             # Split the sra files into fastq files
-            cmd = f'{self.binaries["fasterq-dump"]} --split-3 --skip-technical --outdir {subdirectory} {subdirectory}'
+            cmd = [self.binaries['fasterq-dump'], '--split-3', '--skip-technical',
+                   '--threads', str(self.job_threads()), '--temp', subdirectory, '--outdir', subdirectory, subdirectory]
             with open(log_file, 'w') as log:
-                res = subprocess.run(cmd.split(), stdout=log, stderr=log)
+                res = subprocess.run(cmd, stdout=log, stderr=log)
             if res.returncode != 0:
-                self.logger.error(f'Error while running fasterq-dump on {subdirectory}')
+                self.logger.error('Error while running fasterq-dump on %s', subdirectory)
                 raise Exception(f'Error while running fasterq-dump on {subdirectory}')
             
             res = None
@@ -225,29 +245,70 @@ class SRA(Source):
 
 
             # Compress fastq files
-            for filename in listdir(subdirectory):
-                if not filename.endswith('.fastq'):
-                    continue
-                cmd = f'gzip {path.join(subdirectory, filename)}'
+            with scandir(subdirectory) as entries:
+                fastq_filenames = [entry.name for entry in entries if entry.name.endswith('.fastq')]
+            for filename in fastq_filenames:
+                cmd = [*self.gzip_command().split(), path.join(subdirectory, filename)]
                 with open(log_file, 'a') as log:
-                    res = subprocess.run(cmd.split(), stdout=log, stderr=log)
+                    res = subprocess.run(cmd, stdout=log, stderr=log)
                 if res.returncode != 0:
-                    self.logger.error(f'Error while compressing fastq files in {subdirectory}')
+                    self.logger.error('Error while compressing fastq files in %s', subdirectory)
                     raise Exception(f'Error while compressing fastq files in {subdirectory}')
             
                 gzip_filename = f'{filename}.gz'
                 # Move the compressed files to the SRXP directory
-                move(path.join(subdirectory, gzip_filename), path.join(SRXP_directory, gzip_filename))
+                move_entry(path.join(subdirectory, gzip_filename), path.join(SRXP_directory, gzip_filename))
 
             # Remove the subdirectory
             rmtree(subdirectory)
+
+        # Move to datadir and clean tmp_dir
+        self.move_and_clean(SRXP_directory, datadir)
     
 
     # ---- Toolkit preparation ----
-    
-    def download_sra_toolkit(self) -> dict[str, str]:
+
+    def job_threads(self) -> int:
+        """
+        :return: The number of threads of the multithreaded tools, bounded by the threads allowed to a job.
+        """
+        if self.max_threads is None:
+            return SRA.threads
+        return max(1, min(SRA.threads, self.max_threads))
+
+
+    def gzip_command(self) -> str:
+        """
+        :return: The command compressing files in place. Multithreaded if pigz is available.
+        """
+        if self.binaries['gzip'] == 'pigz':
+            return f'pigz -p {self.job_threads()}'
+        return 'gzip'
+
+
+    def download_sra_toolkit(self) -> dict[str, str]|None:
+        """
+        Downloads and installs the SRA toolkit if necessary, and returns the paths to the binaries.
+        The fastq files are compressed with pigz if it is installed, gzip otherwise.
+
+        The binaries are resolved once per binary directory and shared by all the SRA instances.
+
+        :return: A dictionary containing the paths to the SRA toolkit binaries and to the compressor.
+        """
+        key = path.abspath(self.bin_dir)
+        if key not in SRA.toolkits:
+            binaries = self.find_sra_toolkit()
+            # Failures are not cached: the next instance tries again
+            if binaries is None:
+                return None
+            binaries['gzip'] = 'pigz' if check_binary('pigz') else 'gzip'
+            SRA.toolkits[key] = binaries
+        return SRA.toolkits[key]
+
+
+    def find_sra_toolkit(self) -> dict[str, str]|None:
         """
-        Downloads and installs the SRA toolkit if necessary, and returns the paths to the SRA toolkit binaries.
+        Looks for the SRA toolkit on the system then in the binary directory. Installs it if missing.
 
         :return: A dictionary containing the paths to the SRA toolkit binaries.
         """
@@ -288,7 +349,7 @@ class SRA(Source):
         supported = True
 
         # Local install
-        system = platform.system()
+        system = uname().sysname
         if system == 'Linux':
             download_link = f'https://ftp-trace.ncbi.nlm.nih.gov/sra/sdk/{version}/sratoolkit.{version}-ubuntu64.tar.gz'
             dirname = f'sratoolkit.{version}-ubuntu64'
@@ -302,7 +363,7 @@ class SRA(Source):
                                  f'SRA downloader has not been installed... '
                                  f'Also maybe we can include your system in the auto-installer. '
                                  f'Please submit an issue on github with the following values:'
-                                 f'\nsystem={system}\tplateform={platform.machine()}')
+                                 f'\nsystem={system}\tplateform={uname().machine}')
             return None
 
         # Download sra toolkit
@@ -334,7 +395,7 @@ class SRA(Source):
         cmd = f'ln -s {prefetch_bin} {prefetch_ln}'
         ret = subprocess.run(cmd.split())
         if ret.returncode != 0:
-            self.logger.error(f'Impossible to create symbolic link {prefetch_ln}. SRA downloader has not been installed...')
+            self.logger.error('Impossible to create symbolic link %s. SRA downloader has not been installed...', prefetch_ln)
             return None
 
         fasterqdump_bin = path.abspath(path.join(self.bin_dir, dirname, 'bin', 'fasterq-dump'))
@@ -342,10 +403,10 @@ class SRA(Source):
         cmd = f'ln -s {fasterqdump_bin} {fasterqdump_ln}'
         ret = subprocess.run(cmd.split())
         if ret.returncode != 0:
-            self.logger.error(f'Impossible to create symbolic link {fasterqdump_ln}. SRA downloader has not been installed...')
+            self.logger.error('Impossible to create symbolic link %s. SRA downloader has not been installed...', fasterqdump_ln)
             return None
         
-        self.logger.info(f'SRA downloader binaries installed at {self.bin_dir}')
+        self.logger.info('SRA downloader binaries installed at %s', self.bin_dir)
 
         return {
             'prefetch' : prefetch_ln,
@@ -355,4 +416,4 @@ class SRA(Source):
 
 # --- Cmds ---
 # ./sratoolkit.3.1.1-ubuntu64/bin/prefetch --max-size u --output-directory outtest SRR000001
-# ./sratoolkit.3.1.1-ubuntu64/bin/fasterq-dump --split-3 --skip-technical --outdir outtest outtest/SRR000001
+# ./sratoolkit.3.1.1-ubuntu64/bin/fasterq-dump --split-3 --skip-technical --temp outtest/SRR000001 --outdir outtest outtest/SRR000001
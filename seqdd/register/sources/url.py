@@ -1,13 +1,26 @@
 import logging
+import re
 import subprocess
+import threading
 import time
-from os import path
-from collections.abc import Iterable
+from os import path, remove
+from collections import deque
+from collections.abc import Callable, Collection, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+from itertools import count
+from typing import TypeVar
 from urllib.parse import urlparse
 
-from ...utils.scheduler import CmdLineJob
+from ...utils.download import drop_page_cache
+from ...utils.http import HTTPClient
+from ...utils.scheduler import Job, CmdLineJob, FunctionJob
 from . import Source
 
+T = TypeVar('T')
+R = TypeVar('R')
+
+
 naming = {
     'name': 'url',
     'key': 'url',
@@ -19,10 +32,40 @@ class URL(Source):
     A class that represents a URL downloader.
     """
 
+    max_parallel_queries = 8
+    """The maximum number of URLs checked at the same time."""
+    query_timeout = 60
+    """The maximum time in seconds to wait for the header of a URL."""
+    http_schemes = frozenset(('http', 'https'))
+    """The schemes queried and downloaded in process."""
+    supported_schemes = http_schemes | {'ftp'}
+    """The schemes known to be supported (the non http ones through curl)."""
+    status_line = re.compile(r'^HTTP/\S+\s+([0-9]{3})', re.MULTILINE)
+    """Extracts the status codes from a curl header output."""
+    header_line = re.compile(r'^([^:\s][^:\r\n]*?)\s*:[ \t]*(.*?)\s*$', re.MULTILINE)
+    """Extracts the (name, value) fields from a curl header output."""
+    filename_field = re.compile(r'\bfilename="?([^";]+)')
+    """Extracts the filename from a Content-Disposition field."""
+    download_chunk_size = 1 << 20
+    """The size of the chunks read from the network and written to the files."""
+    files_per_job = 16
+    """The maximum number of files of a same server downloaded by one job."""
+    parallel_transfers = 4
+    """The number of simultaneous transfers of a download job (threads of an http job, curl transfers otherwise)."""
+    job_ids = count()
+    """Unique identifiers of the download jobs."""
+    curl_parallel = None
+    """True if the installed curl supports parallel transfers (curl >= 7.66). None until probed."""
+
 
     def __init__(self, tmpdir: str, bindir: str, logger: logging.Logger) -> None:
         super().__init__(tmpdir, bindir, logger, min_delay=0.5)
 
+        self.http_clients = threading.local()
+        """The HTTP client of each thread querying URL headers (HTTPClient is not thread safe)."""
+        self.opened_clients = []
+        """All the HTTP clients created by the querying threads. Closed once the queries are over."""
+
 
     def is_ready(self) -> bool:
         """
@@ -39,43 +82,194 @@ class URL(Source):
 
         :return: True if the minimum delay has passed, False otherwise.
         """
-        locked = self.mutex.acquire()
+        # Never blocks: the scheduling thread must not wait behind the header queries
+        locked = self.mutex.acquire(blocking=False)
         if locked:
-            ready = time.time() - self.last_query > self.min_delay
+            # Monotonic clock: the delay is not affected by system clock adjustments
+            now = time.monotonic()
+            ready = now - self.last_query > self.min_delay
             if ready:
-                self.last_query = time.time()
+                self.last_query = now
             self.mutex.release()
             return ready
         return False
 
 
+    def wait_my_turn(self) -> None:
+        """
+        Blocks until a URL query is allowed, and reserves it.
+        The query time is reserved under the source lock, then the remaining delay is slept outside of it:
+        the next waiters reserve the following slots without waiting behind the sleepers.
+        """
+        with self.mutex:
+            now = time.monotonic()
+            slot = max(now, self.last_query + self.min_delay)
+            self.last_query = slot
+        time.sleep(slot - now)
+
+
     def remaining_time_before_next_query(self) -> float:
         """
         Calculates the remaining time before the next URL query can be made.
 
         :return: The remaining time in seconds.
         """
-        return max(0, self.min_delay - (time.time() - self.last_query))
+        return max(0, self.min_delay - (time.monotonic() - self.last_query))
 
     
-    def jobs_from_accessions(self, urls: list[str], datadir: str) -> list[CmdLineJob]:
+    def jobs_from_accessions(self, urls: Collection[str], datadir: str) -> Iterator[Job]:
         """
-        Create a list of jobs for downloading files from the given URLs.
+        Create the jobs for downloading files from the given URLs.
+        The filenames of the URLs are queried concurrently, while the jobs are requested.
+        The files of a same server are downloaded by batches, in one process.
+        The http(s) files are downloaded in process over a few reused connections, the others by one parallel curl
+        (one curl per file for the curl versions without parallel transfers).
 
-        :param urls: A list of URLs.
+        :param urls: The URLs.
         :param datadir: The directory path to save the downloaded files.
-        :return: A list of jobs for downloading files.
+        :return: An iterator over the jobs for downloading files.
         """
-        jobs = []
+        urls = list(urls)
+        # Files waiting for their batch, by server
+        batches = {}
+        # The filenames are queried concurrently (still spaced by the source delay) and consumed in order
+        # Only a few queries are submitted ahead: the lookups keep pace with the jobs consumption.
+        try:
+            with ThreadPoolExecutor(max_workers=URL.max_parallel_queries) as executor:
+                filenames = URL.bounded_map(executor, self.get_filename, urls, 2 * URL.max_parallel_queries)
+                for idx, (url, filename) in enumerate(zip(urls, filenames)):
+                    filepath = path.join(datadir, f'url{idx}_{filename}')
+
+                    parsed = urlparse(url)
+                    server = (parsed.scheme, parsed.netloc)
+                    batch = batches.setdefault(server, [])
+                    batch.append((url, filepath))
+                    if len(batch) == URL.files_per_job:
+                        yield from self.batch_jobs(batches.pop(server))
+        finally:
+            self.close_http_clients()
+
+        # Incomplete batches
+        for batch in batches.values():
+            yield from self.batch_jobs(batch)
+
+
+    @staticmethod
+    def bounded_map(executor: ThreadPoolExecutor, func: Callable[[T], R], items: Iterable[T],
+                    window: int) -> Iterator[R]:
+        """
+        Like executor.map, but only submits the calls while at most window of them are not consumed.
+
+        :param executor: The executor running the calls.
+        :param func: The function to call on each item.
+        :param items: The items, lazily iterated.
+        :param window: The maximum number of calls submitted ahead of the consumer.
+        :return: The results, in the order of the items.
+        """
+        futures = deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
 
-        for idx, url in enumerate(urls):
-            filename = self.get_filename(url)
-            filepath = path.join(datadir, f'url{idx}_{filename}')
-            job_name = f'url_{filename}'
 
-            jobs.append(CmdLineJob(f'curl -o {filepath} "{url}"', can_start=self.src_delay_ready, name=job_name))
+    def close_http_clients(self) -> None:
+        """
+        Closes the HTTP clients of the querying threads, once their pool is over.
+        """
+        while self.opened_clients:
+            self.opened_clients.pop().close()
+        self.http_clients = threading.local()
 
-        return jobs
+
+    def batch_jobs(self, files: list[tuple[str, str]]) -> list[Job]:
+        """
+        :param files: The (url, filepath) pairs to download. All the URLs are on the same server, with the same scheme.
+        :return: The jobs downloading the files. A single one, except for the curl versions without parallel transfers.
+        """
+        parsed = urlparse(files[0][0])
+        name = f'url_{parsed.hostname}_{next(URL.job_ids)}'
+        if parsed.scheme in URL.http_schemes:
+            return [FunctionJob(self.download_files, func_args=(files,), can_start=self.src_delay_ready, name=name)]
+
+        # Other schemes: a single curl transfers all the files, several at a time
+        if URL.curl_supports_parallel():
+            cmd = ['curl', '--parallel', '--parallel-max', str(URL.parallel_transfers)]
+            for url, filepath in files:
+                cmd.extend(('-o', filepath, url))
+            return [CmdLineJob(cmd, can_start=self.src_delay_ready, name=name)]
+        # Older curl: one transfer per job
+        return [CmdLineJob(['curl', '-o', filepath, url], can_start=self.src_delay_ready, name=f'{name}_{idx}')
+                for idx, (url, filepath) in enumerate(files)]
+
+
+    @staticmethod
+    def curl_supports_parallel() -> bool:
+        """
+        Probes once if curl supports the parallel transfers (added in curl 7.66).
+
+        :return: True if the --parallel option is available, False otherwise (or if curl is not installed).
+        """
+        if URL.curl_parallel is None:
+            try:
+                res = subprocess.run(['curl', '--help', 'all'], capture_output=True, text=True,
+                                     timeout=URL.query_timeout)
+                URL.curl_parallel = '--parallel' in res.stdout
+            except (OSError, subprocess.TimeoutExpired):
+                URL.curl_parallel = False
+        return URL.curl_parallel
+
+
+    @staticmethod
+    def download_files(files: list[tuple[str, str]]) -> None:
+        """
+        Downloads files of a same server, parallel_transfers at a time.
+        Each transfer thread reuses its own connection for its successive files.
+        Only the successful answers (200) are saved. The other files are reported at the end.
+
+        :param files: The (url, filepath) pairs to download.
+        :raises Exception: If at least one file failed to be downloaded.
+        """
+        # One client (HTTPClient is not thread safe) and one receive buffer per transfer thread
+        local = threading.local()
+        clients = []
+
+        def download(url: str, filepath: str) -> bool:
+            if not hasattr(local, 'client'):
+                local.client = HTTPClient(timeout=URL.query_timeout)
+                clients.append(local.client)
+                # The chunks are read into the buffer, not allocated
+                local.buffer = bytearray(URL.download_chunk_size)
+                local.view = memoryview(local.buffer)
+            print(f'Downloading {url} to {filepath}')
+            try:
+                with local.client.open('GET', url) as response:
+                    if response.status != 200:
+                        print(f'Error code {response.status} for {url}')
+                        return False
+                    with open(filepath, 'wb') as fw:
+                        # Chunks larger than the file buffer are written directly, without an intermediate copy
+                        while (size := response.readinto(local.buffer)) > 0:
+                            fw.write(local.view[:size])
+            except (HTTPException, OSError) as e:
+                print(f'Download of {url} failed: {e}')
+                if path.exists(filepath):
+                    remove(filepath)
+                return False
+            # Only a hint, once the download succeeded
+            drop_page_cache(filepath)
+            return True
+
+        with ThreadPoolExecutor(max_workers=min(URL.parallel_transfers, len(files))) as executor:
+            succeeded = list(executor.map(download, *zip(*files)))
+        for client in clients:
+            client.close()
+
+        failed = [url for (url, _), success in zip(files, succeeded) if not success]
+        if len(failed) > 0:
+            raise Exception(f'{len(failed)} files not downloaded: {", ".join(failed)}')
 
 
     def get_filename(self, url: str) -> str:
@@ -83,77 +277,102 @@ class URL(Source):
         Get the filename from the server through the given URL.
 
         :param url: The URL.
-        :return: The filename extracted from the URL.
+        :return: The filename extracted from the URL. A name without directory.
         """
-        while not self.src_delay_ready():
-            time.sleep(self.remaining_time_before_next_query())
+        self.wait_my_turn()
 
-        verif_cmd = f'curl -X GET url -I "{url}"'
-        res = subprocess.run(verif_cmd, shell=True, capture_output=True, text=True)
+        header = self.query_header(url)
+        if header is not None:
+            code, fields = header
+            match = URL.filename_field.search(fields.get('content-disposition', ''))
+            # Only the last component: a server cannot make the file be written outside the data directory
+            if code in (None, 200) and match is not None:
+                return path.basename(match.group(1).strip())
 
-        filename = None
-        if res.returncode == 0:
-            for line in res.stdout.split('\n'):
-                if line.startswith('HTTP'):
-                    code = int(line.strip().split(' ')[1])
-                    if code != 200:
-                        break
-                if 'filename=' in line:
-                    filename = line.split("=")[1].strip().strip('"')
-                    return filename
+        return path.basename(urlparse(url).path)
 
-        if filename is None:
-            url_parsed = urlparse(url)
-            filename = path.basename(url_parsed.path)
-
-        return filename
 
+    def query_header(self, url: str) -> tuple[int | None, dict[str, str]] | None:
+        """
+        Queries the header of a URL.
+        The http(s) URLs are queried in process, with a HEAD request on a kept alive connection (one client per thread).
+        The other schemes, and the servers refusing HEAD requests, are queried through curl.
 
-    def filter_valid_accessions(self, urls: Iterable[str]):
+        :param url: The URL.
+        :return: A tuple (status code, header fields with lowercase names). The status code is None for non HTTP answers.
+                 None if the server cannot be reached.
+        """
+        if url.partition(':')[0].lower() in URL.http_schemes:
+            client = getattr(self.http_clients, 'client', None)
+            if client is None:
+                client = self.http_clients.client = HTTPClient(timeout=URL.query_timeout)
+                self.opened_clients.append(client)
+            try:
+                code, fields, _ = client.request('HEAD', url)
+            except (HTTPException, OSError, ValueError):
+                return None
+            # Method not allowed or not implemented
+            if code not in (405, 501):
+                return code, fields
+
+        # No shell between python and curl: the url is passed as is, whatever its characters
+        try:
+            res = subprocess.run(['curl', '-sI', url], capture_output=True, text=True, timeout=URL.query_timeout)
+        except subprocess.TimeoutExpired:
+            return None
+        if res.returncode != 0:
+            return None
+
+        # The last status line is the final answer (after the informational ones)
+        codes = URL.status_line.findall(res.stdout)
+        code = int(codes[-1]) if len(codes) > 0 else None
+        fields = {name.lower(): value for name, value in URL.header_line.findall(res.stdout)}
+        return code, fields
+
+
+    def filter_valid_accessions(self, urls: Iterable[str]) -> set[str]:
         """
         Filter out invalid URLs and return a set of valid URLs.
+        The URLs are checked concurrently. The queries are still started one at a time, spaced by the source delay.
 
         :param urls: A list of URLs.
         :return: A set of valid URLs.
         """
-        curl_schemes = {'http', 'https', 'ftp'}
-
         print("Filtering URLs...")
-        valid_urls = set()
-        for url in urls:
-            scheme = url[:url.find(':')].lower()
-            if scheme not in curl_schemes:
-                self.logger.warning(f'WARNING: scheme {scheme} not supported.\nurl ignored: {url}')
-
-            while not self.src_delay_ready():
-                time.sleep(self.remaining_time_before_next_query())
-
-            verif_cmd = f'curl -X GET url -I "{url}"'
-            res = subprocess.run(verif_cmd, shell=True, capture_output=True, text=True)
-
-            if res.returncode != 0:
-                continue
-
-            content_length = 0
-            added = False
-            failed = False
-
-            for line in res.stdout.split('\n'):
-                if line.startswith('HTTP'):
-                    code = int(line.strip().split(' ')[1])
-                    if code == 200:
-                        valid_urls.add(url)
-                        added = True
-                    else:
-                        failed = True
-                        self.logger.error(f'{url}\nCannot download from this URL. Error code: {code}\nSkipping...')
-                    break
-                elif line.startswith('Content-Length'):
-                    content_length = int(line.split(' ')[1])
-                    break
-
-            # Add the URL if it has a content length, even if there is no HTTP code
-            if not failed and not added and content_length > 0:
-                valid_urls.add(url)
-
-        return valid_urls
+        urls = list(urls)
+        # The checks are network bound: the threads wait for the servers, not for the GIL
+        try:
+            with ThreadPoolExecutor(max_workers=URL.max_parallel_queries) as executor:
+                validity = executor.map(self.is_valid_url, urls)
+                return {url for url, valid in zip(urls, validity) if valid}
+        finally:
+            self.close_http_clients()
+
+
+    def is_valid_url(self, url: str) -> bool:
+        """
+        Queries the header of a URL to check that the file can be downloaded.
+
+        :param url: The URL to check.
+        :return: True if the URL is valid, False otherwise.
+        """
+        scheme = url.partition(':')[0].lower()
+        if scheme not in URL.supported_schemes:
+            self.logger.warning('WARNING: scheme %s not supported.\nurl ignored: %s', scheme, url)
+
+        self.wait_my_turn()
+
+        header = self.query_header(url)
+        if header is None:
+            return False
+
+        code, fields = header
+        if code is not None:
+            if code == 200:
+                return True
+            self.logger.error('%s\nCannot download from this URL. Error code: %d\nSkipping...', url, code)
+            return False
+
+        # Add the URL if it has a content length, even if there is no HTTP code
+        content_length = fields.get('content-length', '0')
+        return content_length.isdigit() and int(content_length) > 0
@@ -1,11 +1,19 @@
 
+from __future__ import annotations
+
+import functools
 import importlib
+import importlib.util
 import logging
-import pkgutil
+from os import path, scandir
 from collections.abc import KeysView
-from typing import Type
+from concurrent.futures import ThreadPoolExecutor
+from typing import Type, TYPE_CHECKING
 
-from .sources import Source
+# The sources package pulls the job scheduler (and multiprocessing).
+# It is only imported when the sources are instantiated, not to list them.
+if TYPE_CHECKING:
+    from .sources import Source
 
 class SourceManager:
     """
@@ -20,13 +28,14 @@ class SourceManager:
         :param bindir: Where the helper binaries tools are stored.
         :param logger: The logger object for logging messages.
         """
-        src_modules = SourceManager.list_and_load_sources()
-        self.sources = dict()
-        for src_module in src_modules:
-            if not hasattr(src_module, 'naming'):
-                continue
-            src_init = getattr(src_module, src_module.naming['classname'])
-            self.sources[src_module.naming['key']] = src_init(tmpdir, bindir, logger)
+        src_modules = [module for module in SourceManager.list_and_load_sources() if hasattr(module, 'naming')]
+        # The sources probe (and sometimes install) their binaries in their constructor.
+        # They mostly wait for subprocesses, so they are instantiated concurrently.
+        with ThreadPoolExecutor(max_workers=max(1, len(src_modules))) as executor:
+            futures = {src_module.naming['key']: executor.submit(getattr(src_module, src_module.naming['classname']),
+                                                                 tmpdir, bindir, logger)
+                       for src_module in src_modules}
+        self.sources = {key: future.result() for key, future in futures.items()}
 
     def keys(self) -> KeysView[str]:
         """
@@ -42,26 +51,46 @@ class SourceManager:
         return self.sources.get(source_name, None)
 
     # --- Submodules ---
+    src_module_name = 'seqdd.register.sources'
+    """The package containing one module per source. The key of a source is the name of its module."""
+
+    @staticmethod
+    @functools.cache
+    def source_keys() -> tuple[str, ...]:
+        """
+        The source modules are listed but not imported. Cheap enough to be used at command line parsing.
+
+        :return: The available source names
+        """
+        return SourceManager.list_source_modules()
+
     @staticmethod
-    def source_keys() -> list[str]:
+    @functools.cache
+    def list_source_modules() -> tuple[str, ...]:
         """
-        :return: The list of available source name
+        :return: The names of the modules in sources package, without importing them.
         """
-        src_modules = SourceManager.list_and_load_sources()
-        return [mod.naming['key'] for mod in src_modules if hasattr(mod, 'naming')]
+        spec = importlib.util.find_spec(SourceManager.src_module_name)
+        # Direct directory scan: pkgutil.iter_modules imports inspect, which is slow for a cli startup
+        names = set()
+        for location in spec.submodule_search_locations:
+            with scandir(location) as entries:
+                for entry in entries:
+                    name, ext = path.splitext(entry.name)
+                    if ext == '.py' and name != '__init__' and name.isidentifier():
+                        names.add(name)
+        return tuple(sorted(names))
 
     @staticmethod
-    def list_and_load_sources() -> list[Type[Source]]:
+    @functools.cache
+    def list_and_load_sources() -> tuple[Type[Source], ...]:
         """
-        :return: The list of modules in sources package
+        The sources package is scanned once per process.
+
+        :return: The modules in sources package
         """
-        # Charger le module principal
-        src_module_name = 'seqdd.register.sources'
-        module = importlib.import_module(src_module_name)
-        
-        # Lister les sous-modules
-        submodules = [name for _, name, _ in pkgutil.iter_modules(module.__path__)]
-        
         # Charger dynamiquement chaque sous-module et les ajouter à une liste
-        loaded_sources = [importlib.import_module(f"{src_module_name}.{submodule}") for submodule in submodules]
+        src_module_name = SourceManager.src_module_name
+        loaded_sources = tuple(importlib.import_module(f"{src_module_name}.{submodule}")
+                               for submodule in SourceManager.list_source_modules())
         return loaded_sources
@@ -0,0 +1,84 @@
+import sqlite3
+import time
+from collections.abc import Iterable
+from itertools import islice
+from os import makedirs, path
+
+
+class ValidityCache:
+    """
+    On disk cache of the accessions already validated by the sources.
+    It avoids querying the servers again for accessions validated during previous runs.
+    Only the valid accessions are memorized. An accession rejected once can be a transient server error.
+    """
+
+    expiration = 30 * 24 * 3600
+    """The time in seconds after which a validation must be done again (30 days)."""
+    query_size = 500
+    """The maximum number of accessions looked for in one SQL query (bounded by the sqlite variables limit)."""
+
+
+    def __init__(self, dirpath: str) -> None:
+        """
+        :param dirpath: The directory where the cache is stored.
+        """
+        self.dirpath = dirpath
+        """The directory where the cache is stored."""
+        self.db = None
+        """The sqlite connection storing the validation timestamps. Only available inside a with block."""
+
+
+    def __enter__(self) -> 'ValidityCache':
+        makedirs(self.dirpath, exist_ok=True)
+        self.db = sqlite3.connect(path.join(self.dirpath, 'validity.sqlite'))
+        try:
+            # Rollback journal: WAL needs a shared memory not supported by the network file systems (NFS homes).
+            # Also reverts the caches created in WAL mode.
+            self.db.execute('PRAGMA journal_mode=DELETE')
+            self.db.execute('CREATE TABLE IF NOT EXISTS validity '
+                            '(source TEXT, accession TEXT, time REAL, PRIMARY KEY (source, accession)) WITHOUT ROWID')
+        except sqlite3.Error:
+            self.db.close()
+            self.db = None
+            raise
+        return self
+
+
+    def __exit__(self, *exc) -> None:
+        self.db.commit()
+        self.db.close()
+        self.db = None
+
+
+    def split_known(self, source: str, accessions: Iterable[str]) -> tuple[set[str], set[str]]:
+        """
+        Splits the accessions between the ones recently validated and the unknown ones.
+
+        :param source: The source key of the accessions.
+        :param accessions: The accessions to look for.
+        :return: A tuple (valid accessions, unknown accessions)
+        """
+        oldest = time.time() - ValidityCache.expiration
+        unknown = set(accessions)
+        valid = set()
+        # Batched lookups: one SQL query for up to query_size accessions
+        iterator = iter(unknown)
+        while batch := tuple(islice(iterator, ValidityCache.query_size)):
+            placeholders = ','.join('?' * len(batch))
+            rows = self.db.execute(f'SELECT accession FROM validity WHERE source = ? AND time > ? '
+                                   f'AND accession IN ({placeholders})', (source, oldest, *batch))
+            valid.update(acc for acc, in rows)
+        unknown.difference_update(valid)
+        return valid, unknown
+
+
+    def add_valid(self, source: str, accessions: Iterable[str]) -> None:
+        """
+        Memorizes accessions validated by a source.
+
+        :param source: The source key of the accessions.
+        :param accessions: The valid accessions.
+        """
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO validity VALUES (?, ?, ?)',
+                            ((source, acc, now) for acc in accessions))
@@ -1,8 +1,11 @@
+import errno
+import functools
 import logging
-from os import path, makedirs
-from shutil import rmtree
+import os
+from itertools import chain, zip_longest
+from os import makedirs, rename, scandir, unlink
+from shutil import move, rmtree, which
 import subprocess
-import time
 
 from seqdd.utils.scheduler import JobManager
 from ..register.reg_manager import Register
@@ -15,6 +18,9 @@ class DownloadManager:
     Class to handle download from different source
     """
 
+    pending_jobs_per_process = 4
+    """The number of jobs created in advance per process slot."""
+
     def __init__(self, register: Register, src_manager: SourceManager,
                  logger: logging.Logger, bindir: str ='bin', tmpdir: str ='/tmp'):
         """
@@ -46,11 +52,10 @@ class DownloadManager:
         """
         # Creates the tmp and data directory if it doesn't exist
         makedirs(datadir, exist_ok=True)
-        if logdir is not None and path.exists(logdir):
-            rmtree(logdir)
-        makedirs(logdir)
+        if logdir is not None:
+            clear_directory(logdir)
 
-        # Create a dictionary to store the jobs for each source
+        # Create a dictionary to store the jobs for each source. The jobs are lazily generated.
         jobs = {source: [] for source in self.register.acc_by_src}
 
         # Create the jobs for each source
@@ -60,6 +65,8 @@ class DownloadManager:
 
             if len(reg) > 0:
                 if manipulator.is_ready():
+                    # A job cannot use more threads than the process slots it is counted for
+                    manipulator.max_threads = max_process
                     jobs[source] = manipulator.jobs_from_accessions(reg, datadir)
                     self.logger.info(f'{len(reg)} datasets from {source} will be downloaded.')
                 else:
@@ -68,29 +75,71 @@ class DownloadManager:
 
         # Create a JobManager instance
         manager = JobManager(max_process=max_process, log_folder=logdir, logger=self.logger)
-        manager.start()
 
         # Add jobs to the JobManager in an interleaved way.
         # Doing this will allow the JobManager to start jobs from different sources in parallel.
-        idxs = {source: 0 for source in jobs}
-        total_jobs = sum([len(jobs[source]) for source in jobs])
-        while total_jobs > 0:
-            for source in jobs:
-                if idxs[source] < len(jobs[source]):
-                    manager.add_job(jobs[source][idxs[source]])
-                    idxs[source] += 1
-                    total_jobs -= 1
+        # The jobs are created on demand: only a bounded number of them is pending in the JobManager.
+        # The JobManager is stopped even if a job generation fails.
+        max_pending = max_process * DownloadManager.pending_jobs_per_process
+        interleaved = chain.from_iterable(zip_longest(*jobs.values()))
+        manager.run_jobs((job for job in interleaved if job is not None), max_pending)
 
-        # Wait for all jobs to complete
-        while manager.remaining_jobs() > 0:
-            time.sleep(1)
 
-        # Stop and join the JobManager
-        manager.stop()
-        manager.join()
+# -------------------- Utils downloads --------------------
 
 
-# -------------------- Utils downloads --------------------
+def clear_directory(dirpath: str) -> None:
+    """
+    Empties a directory, creating it if needed.
+    The directory itself is kept: one scandir pass unlinks the files without a stat per entry.
+
+    :param dirpath: The directory to clear.
+    """
+    try:
+        with scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    rmtree(entry.path)
+                else:
+                    unlink(entry.path)
+    except FileNotFoundError:
+        makedirs(dirpath)
+
+
+def move_entry(src: str, dst: str) -> None:
+    """
+    Moves a file or a directory with a single rename when both paths are on the same file system.
+    Falls back to a copy (shutil.move) only across file systems.
+
+    :param src: The path to move.
+    :param dst: The destination path (not a directory to move into).
+    """
+    try:
+        rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        move(src, dst)
+
+
+def drop_page_cache(filepath: str) -> None:
+    """
+    Advises the kernel that a file will not be read again soon, so that its cached pages can be reclaimed.
+    Used on the downloaded datasets, that are written once and not read by seqdd afterwards.
+    Does nothing on systems without posix_fadvise. The errors are ignored: this is only a hint.
+
+    :param filepath: The file path.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
 
 
 def check_binary(path_to_bin: str) -> bool:
@@ -100,12 +149,23 @@ def check_binary(path_to_bin: str) -> bool:
     :param: path_to_bin Path to the binary
     :return: True if the binary is present and executable. False otherwise.
     """
+    # Missing or not executable: no need to spawn a process
+    if which(path_to_bin) is None:
+        return False
+    return runs_version(path_to_bin)
+
+
+@functools.cache
+def runs_version(path_to_bin: str) -> bool:
+    """
+    Runs the binary with --version, at most once per binary and per process.
+
+    :param: path_to_bin Path to the binary
+    :return: True if the binary successfully runs. False otherwise.
+    """
     try:
         cmd = f'{path_to_bin} --version'
         ret = subprocess.run(cmd.split(' '), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         return ret.returncode == 0
     except FileNotFoundError:
         return False
-    
-
-
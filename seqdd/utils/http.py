@@ -0,0 +1,117 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection
+from urllib.parse import urlsplit
+
+
+class HTTPClient:
+    """
+    Minimal HTTP(S) client keeping one persistent connection per server.
+    Successive queries to the same server reuse the TCP connection and the TLS session.
+
+    .. _warning:
+
+        The client is not thread safe. Each thread (or each lock holder) must use its own client.
+
+    """
+
+    def __init__(self, timeout: float = 60) -> None:
+        """
+        :param timeout: The maximum time in seconds to wait for the server.
+        """
+        self.timeout = timeout
+        """The maximum time in seconds to wait for the server."""
+        self.connections = {}
+        """The opened connections indexed by (scheme, server)."""
+
+
+    def request(self, method: str, url: str) -> tuple[int, dict[str, str], bytes]:
+        """
+        Sends a request. Redirections are not followed.
+
+        :param method: The HTTP method (GET, HEAD, ...).
+        :param url: The http or https url to query.
+        :return: The status code, the headers and the body of the answer. The body is returned for any status.
+        :raises ValueError: If the url scheme is not http or https.
+        :raises OSError: If the server cannot be reached.
+        :raises HTTPException: If the server answer is not valid HTTP.
+        """
+        with self.open(method, url) as response:
+            return response.status, {k.lower(): v for k, v in response.getheaders()}, response.read()
+
+
+    @contextmanager
+    def open(self, method: str, url: str) -> Iterator[HTTPResponse]:
+        """
+        Sends a request and gives the answer to read it progressively (see HTTPClient.request for the errors).
+        The part of the body left unread is drained on exit, to be able to reuse the connection.
+
+        :param method: The HTTP method (GET, HEAD, ...).
+        :param url: The http or https url to query.
+        :return: The answer, to be read inside the with block.
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'Unsupported url scheme: {parts.scheme}')
+        target = parts.path or '/'
+        if parts.query:
+            target = f'{target}?{parts.query}'
+
+        key = (parts.scheme, parts.netloc)
+        reused = key in self.connections
+        try:
+            response = self.send(key, method, target)
+        except (HTTPException, OSError):
+            self.close_connection(key)
+            # The server may have closed an idle connection. Retry once on a fresh one.
+            if not reused:
+                raise
+            response = self.send(key, method, target)
+
+        try:
+            yield response
+            response.read()
+        except BaseException:
+            # The connection state is unknown
+            self.close_connection(key)
+            raise
+        if response.will_close:
+            self.close_connection(key)
+
+
+    def send(self, key: tuple[str, str], method: str, target: str) -> HTTPResponse:
+        """
+        Sends a request on the connection to a server, opening it if needed.
+
+        :param key: The (scheme, server) of the connection.
+        :param method: The HTTP method.
+        :param target: The path and query of the url.
+        :return: The answer, not yet read.
+        """
+        connection = self.connections.get(key)
+        if connection is None:
+            scheme, netloc = key
+            connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+            connection = connection_class(netloc, timeout=self.timeout)
+            self.connections[key] = connection
+        connection.request(method, target)
+        return connection.getresponse()
+
+
+    def close_connection(self, key: tuple[str, str]) -> None:
+        """
+        Closes and forgets the connection to a server.
+
+        :param key: The (scheme, server) of the connection.
+        """
+        connection = self.connections.pop(key, None)
+        if connection is not None:
+            connection.close()
+
+
+    def close(self) -> None:
+        """
+        Closes all the opened connections.
+        """
+        for key in list(self.connections):
+            self.close_connection(key)
@@ -0,0 +1,97 @@
+import time
+from collections import deque
+from threading import Lock, Semaphore
+
+
+class RateLimiter:
+    """
+    Limits the queries to a server: at most `rate` query starts per `period` seconds (sliding window),
+    spaced by at least period / rate seconds, and at most `max_inflight` queries running at the same time.
+    The lock only protects the window bookkeeping: the waits and the queries happen outside of it,
+    so independent workers are not serialized.
+
+    Usage: `with limiter: query()`
+    """
+
+    def __init__(self, rate: int, period: float = 1, max_inflight: int = 1) -> None:
+        """
+        :param rate: The maximum number of query starts in a period.
+        :param period: The length in seconds of the sliding window.
+        :param max_inflight: The maximum number of queries running at the same time.
+        """
+        self.period = period
+        """The length in seconds of the sliding window."""
+        self.spacing = period / rate
+        """The minimum time in seconds between two query starts. The queries are not started by bursts."""
+        self.starts = deque(maxlen=rate)
+        """The start times of the last queries, on the time.monotonic clock. The oldest one is dropped on append."""
+        self.mutex = Lock()
+        """Protects the start times."""
+        self.inflight = Semaphore(max_inflight)
+        """Counts the running queries."""
+
+
+    def next_slot(self, now: float) -> float:
+        """
+        Must be called while holding the mutex.
+
+        :param now: The current time on the time.monotonic clock.
+        :return: The earliest time at which a new query can start.
+        """
+        if len(self.starts) == 0:
+            return now
+        slot = max(now, self.starts[-1] + self.spacing)
+        if len(self.starts) == self.starts.maxlen:
+            slot = max(slot, self.starts[0] + self.period)
+        return slot
+
+
+    def try_acquire(self) -> bool:
+        """
+        Reserves a query start if one is available right now. Never blocks.
+        The start is refused while max_inflight queries are running, but the query is not counted as running:
+        meant for the jobs that only need their start to be limited.
+
+        :return: True if the query can start, False otherwise.
+        """
+        if not self.inflight.acquire(blocking=False):
+            return False
+        try:
+            with self.mutex:
+                now = time.monotonic()
+                if self.next_slot(now) > now:
+                    return False
+                self.starts.append(now)
+            return True
+        finally:
+            self.inflight.release()
+
+
+    def acquire(self) -> None:
+        """
+        Waits for a running query slot and a query start, then reserves both.
+        The running query slot must be freed with release.
+        """
+        self.inflight.acquire()
+        # Reserve the start time under the lock, sleep after releasing it.
+        # The next callers compute their slot from this reservation without waiting for the sleep.
+        with self.mutex:
+            slot = self.next_slot(time.monotonic())
+            self.starts.append(slot)
+        time.sleep(max(0., slot - time.monotonic()))
+
+
+    def release(self) -> None:
+        """
+        Frees a running query slot.
+        """
+        self.inflight.release()
+
+
+    def __enter__(self) -> 'RateLimiter':
+        self.acquire()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.release()
@@ -5,10 +5,11 @@ import abc
 import logging
 from os import path
 import sys
+import threading
 from threading import Thread
 from multiprocessing import Process, Event
+from queue import SimpleQueue
 import subprocess
-import time
 from typing import Any
 
 
@@ -18,12 +19,16 @@ class JobManager(Thread):
         """
 
         :param logger: The logger object.
-        :param max_process: the maximum number of process to run at same time
+        :param max_process: the maximum number of process to run at same time.
+                            A job using several cpus takes several of these slots (see Job.cpu_cost).
         :param log_folder: The path to the directory where to write the logs
         """
         super().__init__()
         # Jobs queues
-        self.processes = []
+        self.inbox = SimpleQueue()
+        """Jobs added but not yet seen by the scheduling loop. Only this queue is shared between threads."""
+        self.total = 0
+        """The number of jobs added since the start"""
         self.waiting = []
         self.running = []
         self.dependancies = {}
@@ -34,12 +39,19 @@ class JobManager(Thread):
         # Boolean used to stop the thread
         self.stopped = Event()
         self.stopped.clear()
+        # Set when the scheduling loop must be run without waiting for the next poll (new job, stop)
+        self.wakeup = threading.Event()
+        # Notified at each scheduling step, when jobs may be over
+        self.progress = threading.Condition()
 
     def stop(self) -> None:
         """
         Stop this thread
         """
         self.stopped.set()
+        self.wakeup.set()
+        with self.progress:
+            self.progress.notify_all()
 
     def run(self) -> None:
         """
@@ -47,6 +59,9 @@ class JobManager(Thread):
         """
         # Run the tasks
         while not self.stopped.is_set():
+            # Queue the newly added jobs
+            self.receive_jobs()
+
             # Check currently running processes
             to_remove = []
             for job in self.running:
@@ -68,20 +83,31 @@ class JobManager(Thread):
                 elif not notified:
                     self.logger.error(f'ERROR {job}\n{job.get_returncode()}')
                     self.logger.error(f'Please check the log file for more details: {job.log_file}')
+                # The descendance is already notified
+                self.dependancies.pop(job, None)
 
             # Add new processes
             to_remove = []
+            used_slots = sum(self.slots_of(job) for job in self.running)
             for job in self.waiting:
                 # Max jobs reached
-                if len(self.running) >= self.max_process:
+                if used_slots >= self.max_process:
                     break
                 # Wait for all dependancies to be finished
+                if job.is_over or not job.parents_over():
+                    continue
+                # Not enough free cpus for the oldest startable job. The next jobs do not overtake it:
+                # a stream of small jobs would never leave enough free slots for a large one.
+                if used_slots + self.slots_of(job) > self.max_process:
+                    break
+                # Are all the conditions to run present ?
                 if not job.is_ready():
                     continue
 
                 # Start a new job
                 to_remove.append(job)
                 self.running.append(job)
+                used_slots += self.slots_of(job)
                 self.logger.info(f'START {job}')
                 job.start()
 
@@ -89,7 +115,13 @@ class JobManager(Thread):
             for job in to_remove:
                 self.waiting.remove(job)
 
-            time.sleep(.1)
+            # Wake up the threads waiting for the completion or for free slots
+            with self.progress:
+                self.progress.notify_all()
+
+            # Wait for the next poll of the running processes. Woken up earlier if a job is added.
+            self.wakeup.wait(.1)
+            self.wakeup.clear()
 
         # Clean the running jobs
         for job in self.running:
@@ -97,6 +129,14 @@ class JobManager(Thread):
                 job.stop()
                 job.join()
 
+    def slots_of(self, job: Job) -> int:
+        """
+        :param job: A job.
+        :return: The number of process slots taken by the job. Capped to max_process so any job can start.
+                 The sources limit the threads of their jobs to max_process (see Source.max_threads).
+        """
+        return min(job.cpu_cost, self.max_process)
+
     def cancel_job(self, job: Job) -> None:
         """
 
@@ -126,22 +166,84 @@ class JobManager(Thread):
             logfile = path.join(self.log_folder, logfile_base)
             process.set_log_file(logfile)
 
-        # Add the dependancies of the process
-        for parent in process.parents:
-            if parent not in self.dependancies:
-                self.dependancies[parent] = []
-            self.dependancies[parent].append(process)
+        # The job is queued by the scheduling thread. No lock is taken by the producer.
+        self.inbox.put(process)
+        self.wakeup.set()
+
+
+    def receive_jobs(self) -> None:
+        """
+        Moves the jobs from the inbox to the waiting list.
+        Only called from the scheduling thread: the lists and dependancies are never modified concurrently.
+        """
+        # The lock prevents the completion waiters to see a job neither in the inbox nor in the waiting list
+        with self.progress:
+            while not self.inbox.empty():
+                process = self.inbox.get()
+                self.total += 1
+
+                # A parent already failed (or canceled) before this job was added
+                if any(parent.is_over and parent.get_returncode() != 0 for parent in process.parents):
+                    self.logger.warning(f'CANCEL {process}')
+                    process.stop()
+                    continue
+
+                # Add the dependancies of the process
+                for parent in process.parents:
+                    if parent.is_over:
+                        continue
+                    if parent not in self.dependancies:
+                        self.dependancies[parent] = []
+                    self.dependancies[parent].append(process)
+
+                # Queue the process
+                self.waiting.append(process)
+
+
+    def wait_completion(self) -> None:
+        """
+        Blocks until all the queued jobs are over (or the manager is stopped).
+        """
+        with self.progress:
+            self.progress.wait_for(lambda: self.remaining_jobs() == 0 or self.stopped.is_set())
+
+
+    def wait_capacity(self, max_pending: int) -> None:
+        """
+        Blocks until less than max_pending jobs are queued or running (or the manager is stopped).
+        Used by the producers to add jobs progressively instead of creating all of them at once.
+
+        :param max_pending: The maximum number of jobs not yet over.
+        """
+        with self.progress:
+            self.progress.wait_for(lambda: self.remaining_jobs() < max_pending or self.stopped.is_set())
 
-        # Queue the process
-        self.waiting.append(process)
-        self.processes.append(process)
+
+    def run_jobs(self, jobs: Iterable[Job], max_pending: int) -> None:
+        """
+        Starts the manager, adds the jobs progressively and waits for their completion.
+        The manager is stopped and joined on exit, even if the iteration over the jobs raises:
+        the exception is not hidden behind a scheduling thread still alive.
+
+        :param jobs: The jobs to run. Lazily iterated, at most max_pending jobs are not over at the same time.
+        :param max_pending: The maximum number of jobs not yet over.
+        """
+        self.start()
+        try:
+            for job in jobs:
+                self.wait_capacity(max_pending)
+                self.add_job(job)
+            self.wait_completion()
+        finally:
+            self.stop()
+            self.join()
 
 
     def remaining_jobs(self) -> int:
         """
         :return: The number of job that are running or waiting to start
         """
-        return len(self.waiting) + len(self.running)
+        return self.inbox.qsize() + len(self.waiting) + len(self.running)
 
 
     def add_jobs(self, processes: Iterable[Job]) -> None:
@@ -155,7 +257,7 @@ class JobManager(Thread):
 
 
     def __repr__(self):
-        return f'running: {len(self.running)}\nwaiting: {len(self.waiting)}\ntotal: {len(self.processes)}\n{self.dependancies}'
+        return f'running: {len(self.running)}\nwaiting: {len(self.waiting)}\ntotal: {self.total}\n{self.dependancies}'
 
 
 class Job(metaclass=abc.ABCMeta):
@@ -168,13 +270,14 @@ class Job(metaclass=abc.ABCMeta):
 
     def __init__(self, name: str|None =None, parents: list[Job]|None =None,
                  can_start: Callable = lambda:True,
-                 log_file:str|None = None) -> None:
+                 log_file:str|None = None, cpu_cost: int = 1) -> None:
         """
 
         :param name: The name of this job
         :param parents: the Jobs this job depends on, A list of parent jobs to wait before running this one.
         :param can_start: A function that is called when the job is ready and before starting it. The function must return True when the job is allowed to start
         :param log_file: the name of the file to write logs
+        :param cpu_cost: The number of cpus used by the job (its threads). The JobManager counts it in its process slots.
         """
         self.name = name if name is not None else f'Job_{Job.ID}'
         self.log_file = log_file if log_file is not None else f'{self.name}.log'
@@ -188,11 +291,20 @@ class Job(metaclass=abc.ABCMeta):
         """Subprocess that runs outside of the python program, depends on the job type"""
         self.can_start = can_start
         """A function that is called when the job is ready and before starting it. The function must return True when the job is allowed to start"""
+        self.cpu_cost = cpu_cost
+        """The number of cpus used by the job."""
 
 
     def set_log_file(self, log_file: str) -> None:
         self.log_file = log_file
 
+    def parents_over(self) -> bool:
+        """
+
+        :return: True if all the parents of this job are over. False otherwise.
+        """
+        return all(x.is_over for x in self.parents)
+
     def is_ready(self) -> bool:
         """
 
@@ -202,7 +314,7 @@ class Job(metaclass=abc.ABCMeta):
         if self.is_over:
             return False
         # Parents are still running
-        if not all(x.is_over for x in self.parents):
+        if not self.parents_over():
             return False
         # Are all the conditions to run present ?
         return self.can_start()
@@ -231,17 +343,18 @@ class FunctionJob(Job):
 
     def __init__(self, func_to_run: Callable, func_args: tuple[Any, ...] = (),
                  parents: list[Job] = None, can_start: Callable = lambda:True,
-                 name: str|None = None, log_file: str|None = None):
+                 name: str|None = None, log_file: str|None = None, cpu_cost: int = 1):
         """
         :param func_to_run: The function to run inside the subprocess.
         :param func_args: A tuple of arguments to give to the function to run
         :param parents: A list of parent jobs to wait before running this one.
         :param can_start: A function that is called when the job is ready and before starting it.
                          The function must return True when the job is allowed to start
+        :param cpu_cost: The number of cpus used by the function.
         """
         name = name if name is not None else f'FunctionJob_{Job.ID}'
         log_file = log_file if log_file is not None else f'{name}.log'
-        super().__init__(parents=parents, can_start=can_start, name=name, log_file=f'{name}.log')
+        super().__init__(parents=parents, can_start=can_start, name=name, log_file=f'{name}.log', cpu_cost=cpu_cost)
         self.to_run = func_to_run
         self.args = func_args
         self.process = Process(target=self.wrapping_function, args=())
@@ -325,19 +438,22 @@ class CmdLineJob(Job):
     """
 
 
-    def __init__(self, command_line: str, parents: list[Job]=None,
+    def __init__(self, command_line: str | list[str], parents: list[Job]=None,
                  can_start: Callable = lambda:True,
                  name: str = None,
-                 log_file: str = None) -> None:
+                 log_file: str = None,
+                 cpu_cost: int = 1) -> None:
         """
 
         :param command_line: A command line to run in a bash subprocess.
+                             A list of arguments is run directly, without a shell to parse it.
         :param parents: A list of parent jobs to wait before running this one.
         :param can_start: The function must return True when the job is allowed to start
+        :param cpu_cost: The number of cpus used by the command.
         """
         name = name if name is not None else f'CmdLineJob_{Job.ID}'
         log_file = log_file if log_file is not None else f'{name}.log'
-        super().__init__(parents=parents, can_start=can_start, name=name, log_file=log_file)
+        super().__init__(parents=parents, can_start=can_start, name=name, log_file=log_file, cpu_cost=cpu_cost)
         self.cmd = command_line
 
 
@@ -346,7 +462,7 @@ class CmdLineJob(Job):
         Start this job (in a subprocess).
         """
         with open(self.log_file, 'w') as fw:
-            self.process = subprocess.Popen(self.cmd, shell=True, stdout=fw, stderr=fw)
+            self.process = subprocess.Popen(self.cmd, shell=isinstance(self.cmd, str), stdout=fw, stderr=fw)
 
 
     def stop(self) -> None:
@@ -47,7 +47,7 @@ class TestEna(SeqddTest):
     def test_src_delay_ready(self):
         ena = ENA(self.seqdd_tmp_dir, self.bin_dir, self.logger)
         self.assertTrue(ena.src_delay_ready())
-        ena.last_query = time.time()
+        ena.last_query = time.monotonic()
         self.assertFalse(ena.src_delay_ready())
 
 
@@ -64,7 +64,7 @@ class TestEna(SeqddTest):
         acc = 'GCA_003543015.1'
         datadir = os.path.join(self._tmp_dir.name, 'data')
         os.mkdir(datadir)
-        jobs = ena.jobs_from_accessions([acc], datadir)
+        jobs = list(ena.jobs_from_accessions([acc], datadir))
         self.assertEqual(len(jobs), 3)
         curl, gzip, clean = jobs
         self.assertEqual(curl.name, f'ena_{acc}_{acc}_download')
@@ -151,3 +151,68 @@ class TestEna(SeqddTest):
         self.assertEqual(got_acc_type, 'Invalid')
         self.assertEqual(log_msg,
                          f'Invalid accession: {acc}')
+
+
+    def test_scan_answer(self):
+        # The tokens and the error tag are split across the chunk boundaries
+        chunks = [b'<PRIMARY_ID>SRR12', b'3456</PRIMARY_ID><PRIMARY_ID>ERX0', b'00009.1</PRIMARY_ID><Error',
+                  b'Details>bad</ErrorDetails> SRR1']
+        error, tokens = ENA.scan_answer(chunks)
+        self.assertIn(b'ErrorDetails', error)
+        self.assertSetEqual(tokens, {b'SRR123456', b'ERX000009.1', b'SRR1'})
+        # No error in the answer
+        error, tokens = ENA.scan_answer([b'<ID>SRR1', b'23</ID>'])
+        self.assertIsNone(error)
+        self.assertSetEqual(tokens, {b'SRR123'})
+
+
+    def test_valid_accessions_on_API_bisection(self):
+        ena = ENA(self.seqdd_tmp_dir, self.bin_dir, self.logger)
+        bad = 'SRR000003'
+        queries = []
+
+        def fake_query_api_status(query, consume):
+            # ENA rejects the whole query when it contains a bad accession
+            accessions = query.split('/')[-1].split('?')[0].split(',')
+            queries.append(accessions)
+            if bad in accessions:
+                return 400, (b'<ErrorDetails>', set())
+            return 200, (None, {acc.encode() for acc in accessions})
+
+        ena.query_api_status = fake_query_api_status
+        accessions = [f'SRR00000{i}' for i in range(1, 9)]
+        with self.catch_log() as log:
+            valid = ena.valid_accessions_on_API(accessions)
+            log_msg = log.get_value().rstrip()
+        self.assertListEqual(valid, [acc for acc in accessions if acc != bad])
+        # The error of the isolated accession is reported
+        self.assertIn(f'xml/{bad}?', log_msg)
+        self.assertTrue(log_msg.endswith(f'Accession(s) not found on ENA servers: {bad}'))
+        # The bad accession is isolated by halving: 1 + 2 * log2(8) queries
+        self.assertEqual(len(queries), 7)
+        self.assertIn([bad], queries)
+
+
+    def test_valid_accessions_on_API_server_error(self):
+        ena = ENA(self.seqdd_tmp_dir, self.bin_dir, self.logger)
+        queries = []
+
+        def fake_query_api_status(query, consume):
+            queries.append(query)
+            return 503, (b'<ErrorDetails>', set())
+
+        ena.query_api_status = fake_query_api_status
+        accessions = [f'SRR00000{i}' for i in range(1, 9)]
+        retry_delay = ENA.retry_delay
+        ENA.retry_delay = 0
+        try:
+            with self.catch_log() as log:
+                valid = ena.valid_accessions_on_API(accessions)
+                log_msg = log.get_value()
+        finally:
+            ENA.retry_delay = retry_delay
+        self.assertListEqual(valid, [])
+        # The query is retried, not split, and its accessions are not reported as missing from ENA
+        self.assertEqual(len(queries), 1 + ENA.max_retries)
+        self.assertIn('not validated', log_msg)
+        self.assertNotIn('not found on ENA servers', log_msg)
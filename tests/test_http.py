@@ -0,0 +1,54 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+from tests import SeqddTest
+from seqdd.utils.http import HTTPClient
+
+
+class PortHandler(BaseHTTPRequestHandler):
+    """Answers the client port, to check the connection reuse."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = str(self.client_address[1]).encode()
+        self.send_response(404 if self.path == '/missing' else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPClient(SeqddTest):
+
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), PortHandler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self._thread = Thread(target=self.server.serve_forever)
+        self._thread.start()
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+    def test_keep_alive(self):
+        client = HTTPClient()
+        status, headers, first_port = client.request('GET', f'{self.url}/a')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-length'], str(len(first_port)))
+        # The same connection is used for the next query, even for an error status
+        status, _, second_port = client.request('GET', f'{self.url}/missing')
+        self.assertEqual(status, 404)
+        self.assertEqual(first_port, second_port)
+        client.close()
+
+
+    def test_unsupported_scheme(self):
+        with self.assertRaises(ValueError):
+            HTTPClient().request('GET', 'ftp://127.0.0.1/file')
@@ -0,0 +1,39 @@
+import logging
+
+from tests import SeqddTest
+from seqdd.__main__ import AnyPattern, compile_patterns
+
+
+class TestCompilePatterns(SeqddTest):
+
+
+    @classmethod
+    def setUpClass(cls):
+        cls.logger = logging.getLogger('seqdd')
+
+
+    def test_union(self):
+        pattern = compile_patterns(['GCA', 'SRR'], self.logger)
+        self.assertNotIsInstance(pattern, AnyPattern)
+        self.assertListEqual([acc for acc in ['GCA_1', 'SRR1', 'ERR1'] if pattern.match(acc)], ['GCA_1', 'SRR1'])
+
+
+    def test_inline_global_flags(self):
+        # The flag only applies to its own regexp, wherever it is placed
+        for regexps in (['(?i)gca_0', 'SRR'], ['SRR', '(?i)gca_0|ABC']):
+            with self.subTest(regexps=regexps):
+                with self.catch_log() as log:
+                    pattern = compile_patterns(regexps, self.logger)
+                    log_msg = log.get_value()
+                self.assertIsInstance(pattern, AnyPattern)
+                self.assertIn('matched one by one', log_msg)
+                self.assertTrue(pattern.match('GCA_01'))
+                self.assertTrue(pattern.match('SRR1'))
+                self.assertFalse(pattern.match('srr1'))
+
+
+    def test_backreference(self):
+        with self.catch_log():
+            pattern = compile_patterns(['X', '(S)\\1'], self.logger)
+        self.assertTrue(pattern.match('SS'))
+        self.assertFalse(pattern.match('SX'))
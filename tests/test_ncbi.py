@@ -0,0 +1,51 @@
+import logging
+import os
+import tempfile
+
+from tests import SeqddTest
+from seqdd.register.sources.ncbi import NCBI
+
+
+# Answers the summary queries with a fixed json lines report
+FAKE_DATASETS = '''#!/bin/sh
+if [ "$1" = "--version" ]; then
+    echo "datasets version: fake"
+    exit 0
+fi
+echo '{"accession": "GCA_000001635.9", "paired_accession": "GCF_000001635.27"}'
+echo '{"accession":"GCA_003774525.2"}'
+'''
+
+
+class TestNCBI(SeqddTest):
+
+
+    @classmethod
+    def setUpClass(cls):
+        cls.logger = logging.getLogger('seqdd')
+
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='seqdd-')
+        self.seqdd_tmp_dir = os.path.join(self._tmp_dir.name, 'tmp')
+        self.bin_dir = os.path.join(self._tmp_dir.name, 'bin')
+        os.mkdir(self.bin_dir)
+        self.fake_bin = os.path.join(self.bin_dir, 'datasets')
+        with open(self.fake_bin, 'w') as fw:
+            fw.write(FAKE_DATASETS)
+        os.chmod(self.fake_bin, 0o755)
+
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+
+    def test_query_summary(self):
+        ncbi = NCBI(self.seqdd_tmp_dir, self.bin_dir, self.logger)
+        # A datasets installed on the system would be preferred
+        ncbi.bin = self.fake_bin
+        valid, unknown = ncbi.query_summary(['GCA_000001635.9', 'GCA_003774525.2', 'GCF_000001635.27',
+                                             'GCA_999999999.1'])
+        self.assertSetEqual(valid, {'GCA_000001635.9', 'GCA_003774525.2'})
+        # The paired accession of a report does not validate it
+        self.assertSetEqual(unknown, {'GCF_000001635.27', 'GCA_999999999.1'})
@@ -0,0 +1,46 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tests import SeqddTest
+from seqdd.utils.ratelimit import RateLimiter
+
+
+class TestRateLimiter(SeqddTest):
+
+
+    def test_try_acquire(self):
+        # Starts spaced by 0.5s
+        limiter = RateLimiter(2, period=1)
+        self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire())
+        time.sleep(0.7)
+        self.assertTrue(limiter.try_acquire())
+
+
+    def test_max_inflight(self):
+        # The start spacing is negligible: only the running queries are limited
+        limiter = RateLimiter(1000, period=0.001, max_inflight=1)
+        with limiter:
+            self.assertFalse(limiter.try_acquire())
+        self.assertTrue(limiter.try_acquire())
+
+
+    def test_acquire(self):
+        # Starts spaced by 0.3s
+        limiter = RateLimiter(2, period=0.6, max_inflight=3)
+        starts = []
+
+        def query():
+            with limiter:
+                starts.append(time.monotonic())
+
+        with ThreadPoolExecutor(3) as executor:
+            for _ in range(3):
+                executor.submit(query)
+        starts.sort()
+        # The concurrent queries are not started by bursts
+        self.assertGreater(starts[1] - starts[0], 0.25)
+        self.assertGreater(starts[2] - starts[1], 0.25)
+        # All the running query slots are freed. A start is available once the spacing is over.
+        time.sleep(0.6)
+        self.assertTrue(limiter.try_acquire())
@@ -0,0 +1,88 @@
+import logging
+import tempfile
+import os
+import re
+
+from tests import SeqddTest
+from seqdd.register.reg_manager import Register, save_source, load_source
+
+
+class TestRegister(SeqddTest):
+
+
+    @classmethod
+    def setUpClass(cls):
+        cls.logger = logging.getLogger('seqdd')
+
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='seqdd-')
+        self.reg_dir = os.path.join(self._tmp_dir.name, 'register')
+        os.mkdir(self.reg_dir)
+        save_source(os.path.join(self.reg_dir, 'ncbi.txt'), ['GCA_000001635.9', 'GCA_003774525.2'])
+        save_source(os.path.join(self.reg_dir, 'sra.txt'), ['SRR000001'])
+
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+
+    def test_load_from_dir(self):
+        reg = Register(self.logger, dirpath=self.reg_dir)
+        self.assertSetEqual(reg.acc_by_src['ncbi'], {'GCA_000001635.9', 'GCA_003774525.2'})
+        self.assertSetEqual(reg.acc_by_src['sra'], {'SRR000001'})
+
+
+    def test_load_restricted_sources(self):
+        reg = Register(self.logger, dirpath=self.reg_dir, sources=['sra'])
+        self.assertListEqual(list(reg.acc_by_src), ['sra'])
+        self.assertSetEqual(reg.acc_by_src['sra'], {'SRR000001'})
+
+
+    def test_save_restricted_sources(self):
+        reg = Register(self.logger, dirpath=self.reg_dir, sources=['sra'])
+        reg.acc_by_src['sra'].add('SRR000002')
+        reg.save_to_dir(self.reg_dir)
+        # The unmanaged subregisters are left untouched
+        self.assertSetEqual(load_source(os.path.join(self.reg_dir, 'ncbi.txt')),
+                            {'GCA_000001635.9', 'GCA_003774525.2'})
+        self.assertSetEqual(load_source(os.path.join(self.reg_dir, 'sra.txt')), {'SRR000001', 'SRR000002'})
+
+
+    def test_filter_accessions(self):
+        reg = Register(self.logger, dirpath=self.reg_dir)
+        pattern = re.compile('(?:GCA_0000)|(?:SRR)')
+        self.assertListEqual(reg.filter_accessions('ncbi', pattern), ['GCA_000001635.9'])
+        self.assertListEqual(reg.filter_accessions('sra', pattern), ['SRR000001'])
+        self.assertListEqual(reg.filter_accessions('sra', None), [])
+
+
+    def test_remove_accessions(self):
+        reg = Register(self.logger, dirpath=self.reg_dir)
+        reg.remove_accessions('ncbi', ['GCA_000001635.9', 'GCA_999999999.1'])
+        self.assertSetEqual(reg.acc_by_src['ncbi'], {'GCA_003774525.2'})
+
+
+    def test_save_unchanged(self):
+        reg = Register(self.logger, dirpath=self.reg_dir)
+        ncbi_path = os.path.join(self.reg_dir, 'ncbi.txt')
+        sra_path = os.path.join(self.reg_dir, 'sra.txt')
+        os.utime(ncbi_path, (0, 0))
+        os.utime(sra_path, (0, 0))
+        reg.acc_by_src['sra'].add('SRR000002')
+        reg.save_to_dir(self.reg_dir)
+        # Only the modified subregister is rewritten
+        self.assertEqual(os.stat(ncbi_path).st_mtime, 0)
+        self.assertNotEqual(os.stat(sra_path).st_mtime, 0)
+        self.assertSetEqual(load_source(sra_path), {'SRR000001', 'SRR000002'})
+
+
+    def test_save_modified(self):
+        reg = Register(self.logger, dirpath=self.reg_dir)
+        ncbi_path = os.path.join(self.reg_dir, 'ncbi.txt')
+        reg.remove_accessions('sra', ['SRR000001'])
+        reg.acc_by_src['ncbi'].add('GCA_000002035.4')
+        reg.save_to_dir(self.reg_dir, modified=['sra'])
+        # Only the listed subregisters are saved. The emptied one is removed.
+        self.assertFalse(os.path.exists(os.path.join(self.reg_dir, 'sra.txt')))
+        self.assertSetEqual(load_source(ncbi_path), {'GCA_000001635.9', 'GCA_003774525.2'})
@@ -0,0 +1,84 @@
+import logging
+import os
+import tempfile
+
+from tests import SeqddTest
+from seqdd.utils.scheduler import JobManager, CmdLineJob
+
+
+class TestJobManager(SeqddTest):
+
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='seqdd-')
+        self.logger = logging.getLogger('seqdd.test')
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+
+    def new_manager(self, max_process=2):
+        return JobManager(self.logger, max_process=max_process, log_folder=self._tmp_dir.name)
+
+
+    def test_run_jobs_generation_error(self):
+        manager = self.new_manager()
+
+        def jobs():
+            yield CmdLineJob(['true'], name='first')
+            raise FileNotFoundError('curl')
+
+        # The error is raised to the caller and the scheduling thread is over
+        with self.assertRaises(FileNotFoundError):
+            manager.run_jobs(jobs(), max_pending=4)
+        self.assertFalse(manager.is_alive())
+
+
+    def test_cpu_cost(self):
+        manager = self.new_manager(max_process=2)
+        manager.start()
+        trace = os.path.join(self._tmp_dir.name, 'trace')
+        # The first job takes a slot, the large one waits for both of them.
+        # The last small job does not overtake the large one, even if it fits in the free slot.
+        manager.add_jobs([
+            CmdLineJob(f'echo small_1 >> {trace}; sleep 0.5', name='small_1'),
+            CmdLineJob(f'echo large >> {trace}; sleep 0.1', name='large', cpu_cost=2),
+            CmdLineJob(f'echo small_2 >> {trace}', name='small_2'),
+        ])
+        manager.wait_completion()
+        manager.stop()
+        manager.join()
+        with open(trace) as fr:
+            self.assertListEqual(fr.read().split(), ['small_1', 'large', 'small_2'])
+
+
+    def test_wait_capacity(self):
+        manager = self.new_manager()
+        manager.start()
+        manager.add_jobs([CmdLineJob(['sleep', '0.2']), CmdLineJob(['sleep', '0.2'])])
+        # Returns once one of the jobs is over
+        manager.wait_capacity(2)
+        self.assertLess(manager.remaining_jobs(), 2)
+        manager.wait_capacity(1)
+        self.assertEqual(manager.remaining_jobs(), 0)
+        manager.stop()
+        manager.join()
+
+
+    def test_cancel_child_of_failed_job(self):
+        manager = self.new_manager()
+        manager.start()
+        parent = CmdLineJob(['false'], name='parent')
+        manager.add_job(parent)
+        manager.wait_completion()
+        # The parent already failed when the child is added: the child is canceled without running
+        child = CmdLineJob(['true'], parents=[parent], name='child')
+        manager.add_job(child)
+        manager.wait_completion()
+        manager.stop()
+        manager.join()
+        self.assertTrue(child.is_over)
+        self.assertIsNone(child.process)
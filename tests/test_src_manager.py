@@ -0,0 +1,13 @@
+from tests import SeqddTest
+from seqdd.register.src_manager import SourceManager
+
+
+class TestSourceManager(SeqddTest):
+
+
+    def test_source_keys(self):
+        keys = SourceManager.source_keys()
+        self.assertTupleEqual(keys, ('ena', 'ncbi', 'sra', 'url'))
+        # The source keys are listed from the module names. They must match the declared keys.
+        loaded_keys = tuple(mod.naming['key'] for mod in SourceManager.list_and_load_sources())
+        self.assertTupleEqual(keys, loaded_keys)
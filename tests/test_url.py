@@ -0,0 +1,54 @@
+import logging
+import tempfile
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+from tests import SeqddTest
+from seqdd.register.sources.url import URL
+
+
+class DispositionHandler(BaseHTTPRequestHandler):
+    """Answers a Content-Disposition filename with a directory traversal."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Disposition', 'attachment; filename="../../evil.txt"')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestURL(SeqddTest):
+
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='seqdd-')
+        self.server = HTTPServer(('127.0.0.1', 0), DispositionHandler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self._thread = Thread(target=self.server.serve_forever)
+        self._thread.start()
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+        self._tmp_dir.cleanup()
+
+
+    def test_get_filename_basename(self):
+        url = URL(self._tmp_dir.name, self._tmp_dir.name, logging.getLogger('seqdd'))
+        # Only the last component of the server filename is kept
+        self.assertEqual(url.get_filename(f'{self.url}/download?id=1'), 'evil.txt')
+        url.close_http_clients()
+
+
+    def test_filter_closes_clients(self):
+        url = URL(self._tmp_dir.name, self._tmp_dir.name, logging.getLogger('seqdd'))
+        self.assertSetEqual(url.filter_valid_accessions([f'{self.url}/a']), {f'{self.url}/a'})
+        # The keep alive connections of the querying threads are closed with their pool
+        self.assertListEqual(url.opened_clients, [])
@@ -0,0 +1,41 @@
+import tempfile
+import os
+import time
+
+from tests import SeqddTest
+from seqdd.register.validity_cache import ValidityCache
+
+
+class TestValidityCache(SeqddTest):
+
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='seqdd-')
+        self.cache_dir = os.path.join(self._tmp_dir.name, '.valcache')
+
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+
+    def test_split_known(self):
+        with ValidityCache(self.cache_dir) as cache:
+            cache.add_valid('sra', ['SRR000001'])
+        # The cache persists between two openings
+        with ValidityCache(self.cache_dir) as cache:
+            valid, unknown = cache.split_known('sra', {'SRR000001', 'SRR000002'})
+            self.assertSetEqual(valid, {'SRR000001'})
+            self.assertSetEqual(unknown, {'SRR000002'})
+            # Keys are source specific
+            valid, unknown = cache.split_known('ena', {'SRR000001'})
+            self.assertSetEqual(valid, set())
+            self.assertSetEqual(unknown, {'SRR000001'})
+
+
+    def test_expiration(self):
+        with ValidityCache(self.cache_dir) as cache:
+            cache.add_valid('sra', ['SRR000001'])
+            cache.db.execute('UPDATE validity SET time = ?', (time.time() - ValidityCache.expiration - 1,))
+            valid, unknown = cache.split_known('sra', ['SRR000001'])
+        self.assertSetEqual(valid, set())
+        self.assertSetEqual(unknown, {'SRR000001'})